@@ -0,0 +1,307 @@
+# -*- coding:  utf-8 -*-
+"""In-process stand-in for pymongo Database used by benchmarks.
+
+Documents are kept BSON encoded and decoded on every read, so reads and
+writes pay the encoding cost of a real round trip without network and
+server time. Only the subset of queries and updates used by the library
+is supported.
+"""
+
+from bson import BSON
+from pymongo.objectid import ObjectId
+
+MISSING = object()
+
+
+def get_path(doc, path):
+    for part in path.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        elif isinstance(doc, list) and part.isdigit() and int(part) < len(doc):
+            doc = doc[int(part)]
+        else:
+            return MISSING
+    return doc
+
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _equal(value, other):
+    if isinstance(value, list) and not isinstance(other, list):
+        return other in value
+    if value is MISSING:
+        return other is None
+    return value == other
+
+
+def _operator(op, value, arg):
+    present = value is not MISSING
+    if op == '$gt':
+        return present and value > arg
+    if op == '$gte':
+        return present and value >= arg
+    if op == '$lt':
+        return present and value < arg
+    if op == '$lte':
+        return present and value <= arg
+    if op == '$ne':
+        return not _equal(value, arg)
+    if op == '$in':
+        return any(_equal(value, a) for a in arg)
+    if op == '$nin':
+        return not any(_equal(value, a) for a in arg)
+    if op == '$all':
+        return isinstance(value, list) and all(a in value for a in arg)
+    if op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    if op == '$exists':
+        return present == bool(arg)
+    raise NotImplementedError(op)
+
+
+def matches(doc, spec):
+    "Check doc against query spec"
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            if not all(matches(doc, s) for s in cond):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, s) for s in cond):
+                return False
+        elif isinstance(cond, dict) and cond and \
+                all(k.startswith('$') for k in cond):
+            value = get_path(doc, key)
+            if not all(_operator(op, value, arg)
+                       for op, arg in cond.iteritems()):
+                return False
+        elif not _equal(get_path(doc, key), cond):
+            return False
+    return True
+
+
+def project(doc, fields):
+    "Apply find() projection"
+    if not fields:
+        return doc
+    if isinstance(fields, list):
+        fields = dict((f, 1) for f in fields)
+    include = [k for k, v in fields.iteritems() if v and k != '_id']
+    if include:
+        result = {}
+        for key in include:
+            value = get_path(doc, key)
+            if value is not MISSING:
+                set_path(result, key, value)
+        if fields.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    for key, v in fields.iteritems():
+        if not v:
+            unset_path(doc, key)
+    return doc
+
+
+class Cursor(object):
+    def __init__(self, collection, spec, fields):
+        self._collection = collection
+        self._spec = spec or {}
+        self._fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, num):
+        self._skip = num
+        return self
+
+    def limit(self, num):
+        self._limit = num
+        return self
+
+    def hint(self, index):
+        return self
+
+    def batch_size(self, num):
+        return self
+
+    def _matching(self):
+        stored = self._collection._docs
+        _id = self._spec.get('_id', MISSING)
+        if len(self._spec) == 1 and _id is not MISSING and \
+                not isinstance(_id, dict):
+            # lookup by _id uses index
+            data = stored.get(_id)
+            return [] if data is None else [BSON(data).decode()]
+        docs = [BSON(data).decode() for data in stored.itervalues()]
+        return [doc for doc in docs if matches(doc, self._spec)]
+
+    def _run(self):
+        docs = self._matching()
+        docs.sort(key=lambda doc: doc['_id'])
+        for key, direction in reversed(self._sort or []):
+            docs.sort(key=lambda doc: get_path(doc, key), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return iter([project(doc, self._fields) for doc in docs])
+
+    def count(self):
+        return len(self._matching())
+
+    def explain(self):
+        return {'cursor': 'BasicCursor', 'n': self.count(),
+                'nscanned': len(self._collection._docs)}
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = self._run()
+        return self._results.next()
+
+
+class RawBatchCursor(Cursor):
+    "Cursor of find_raw_batches(), batches are concatenated BSON documents"
+    def __init__(self, collection, spec, fields):
+        Cursor.__init__(self, collection, spec, fields)
+        self._batch_size = 101
+
+    def batch_size(self, num):
+        self._batch_size = num
+        return self
+
+    def _run(self):
+        stored = self._collection._docs
+        if self._spec or self._sort or self._fields:
+            datas = [BSON.encode(doc) for doc in Cursor._run(self)]
+        else: # stored documents are sent as they are
+            datas = [stored[_id] for _id in sorted(stored)][self._skip:]
+            if self._limit:
+                datas = datas[:self._limit]
+        size = self._batch_size
+        return iter([''.join(datas[i:i + size])
+                     for i in xrange(0, len(datas), size)])
+
+
+class Collection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = {}
+
+    def _store(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        self._docs[doc['_id']] = BSON.encode(doc)
+        return doc['_id']
+
+    def find(self, spec=None, fields=None):
+        return Cursor(self, spec, fields)
+
+    def find_raw_batches(self, spec=None, fields=None):
+        return RawBatchCursor(self, spec, fields)
+
+    def find_one(self, spec=None, fields=None):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        for doc in self.find(spec, fields).limit(1):
+            return doc
+        return None
+
+    def insert(self, doc_or_docs, safe=False):
+        if isinstance(doc_or_docs, list):
+            return [self._store(doc) for doc in doc_or_docs]
+        return self._store(doc_or_docs)
+
+    def save(self, doc, safe=False):
+        return self._store(doc)
+
+    def update(self, spec, document, upsert=False, safe=False, multi=False):
+        docs = Cursor(self, spec, None)._matching()
+        if not multi:
+            docs = docs[:1]
+        if not docs and upsert:
+            docs = [dict((k, v) for k, v in spec.iteritems()
+                         if not k.startswith('$') and not isinstance(v, dict))]
+        for doc in docs:
+            if not any(k.startswith('$') for k in document):
+                replacement = dict(document)
+                if '_id' in doc:
+                    replacement['_id'] = doc['_id']
+                self._store(replacement)
+                continue
+            for op, changes in document.iteritems():
+                for key, value in changes.iteritems():
+                    if op == '$set':
+                        set_path(doc, key, value)
+                    elif op == '$unset':
+                        unset_path(doc, key)
+                    elif op == '$inc':
+                        current = get_path(doc, key)
+                        set_path(doc, key, value + (0 if current is MISSING
+                                                    else current))
+                    elif op == '$push':
+                        current = get_path(doc, key)
+                        set_path(doc, key, ([] if current is MISSING
+                                            else current) + [value])
+                    else:
+                        raise NotImplementedError(op)
+            self._store(doc)
+        return {'n': len(docs)}
+
+    def remove(self, spec=None, safe=False):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        for doc in Cursor(self, spec, None)._matching():
+            del self._docs[doc['_id']]
+
+    def create_index(self, keys, **kwargs):
+        return '_'.join('%s_%s' % key for key in keys)
+
+    ensure_index = create_index
+
+    def index_information(self):
+        return {'_id_': {'key': [('_id', 1)]}}
+
+    def drop(self):
+        self._docs.clear()
+
+
+class Database(object):
+    "Dictionary of collections, created on first access"
+    def __init__(self, name='benchmark'):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def dereference(self, dbref):
+        return self[dbref.collection].find_one({'_id': dbref.id})
@@ -0,0 +1,58 @@
+# -*- coding:  utf-8 -*-
+"""Synthetic documents for benchmarks.
+
+Documents are built from seeded random generator, so every run works on
+the same data. A profile sets nesting depth, number of keys per level
+and length of strings.
+"""
+
+import random
+
+PROFILES = {
+    # depth, width, text length
+    'small': (1, 4, 10),
+    'medium': (2, 6, 30),
+    'large': (3, 8, 100),
+}
+
+WORDS = ('alpha', 'beta', 'gamma', 'delta', 'omega', 'kappa', 'sigma')
+
+
+def text(rng, size):
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rng.choice(WORDS))
+    return u' '.join(words)[:size]
+
+
+def make_doc(rng, depth, width, size):
+    """Document with 'width' scalar fields, and below depth 'width'
+    nested documents and a list of them."""
+    doc = {}
+    for i in range(width):
+        kind = i % 3
+        if kind == 0:
+            doc['int%d' % i] = rng.randint(0, 1000)
+        elif kind == 1:
+            doc['text%d' % i] = text(rng, size)
+        else:
+            doc['float%d' % i] = rng.random()
+    if depth > 0:
+        for i in range(width // 2):
+            doc['child%d' % i] = make_doc(rng, depth - 1, width, size)
+        doc['items'] = [make_doc(rng, depth - 1, width // 2 or 1, size)
+                        for i in range(width // 2)]
+    return doc
+
+
+def make_docs(count, profile='medium', seed=0):
+    "List of documents of profile, each with 'rank' and 'name' fields"
+    depth, width, size = PROFILES[profile]
+    rng = random.Random(seed)
+    docs = []
+    for rank in range(count):
+        doc = make_doc(rng, depth, width, size)
+        doc['rank'] = rank
+        doc['name'] = text(rng, 12)
+        docs.append(doc)
+    return docs
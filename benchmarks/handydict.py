@@ -0,0 +1,92 @@
+# -*- coding:  utf-8 -*-
+"""Measure HandyDict/Model construction cost for deep documents.
+
+    python benchmarks/handydict.py [depth] [width]
+
+For every access pattern prints time per document and peak memory
+growth while keeping all documents alive. Each pattern runs in its own
+process so peak memory numbers do not affect each other.
+"""
+
+import os
+import sys
+import time
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mongodbobject import Model
+
+DOCS = 1000
+
+
+class Doc(Model):
+    pass
+
+
+def make_doc(depth, width):
+    "Build pymongo-like document with nested dicts and lists"
+    if depth == 0:
+        return dict(('field%d' % i, i) for i in range(width))
+    doc = dict(('field%d' % i, make_doc(depth - 1, width)) for i in range(width))
+    doc['items'] = [make_doc(depth - 1, width) for i in range(width)]
+    doc['name'] = u'document'
+    return doc
+
+
+def touch_all(value):
+    "Read every nested value through HandyDict access"
+    if isinstance(value, dict):
+        for k in value.keys():
+            touch_all(value[k])
+    elif isinstance(value, list):
+        for v in value:
+            touch_all(v)
+
+
+PATTERNS = {
+    'construct': lambda doc: None,
+    'touch_one': lambda doc: doc.name,
+    'touch_nested': lambda doc: doc.field0.field0,
+    'touch_all': touch_all,
+}
+
+
+def run(pattern, depth, width):
+    "Construct documents, return (seconds per doc, peak KB growth)"
+    access = PATTERNS[pattern]
+    raw = [make_doc(depth, width) for i in range(DOCS)]
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    keep = []
+    start = time.time()
+    for doc in raw:
+        model = Doc(doc)
+        access(model)
+        keep.append(model)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    return elapsed / DOCS, peak
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    if len(sys.argv) > 3:
+        per_doc, peak = run(sys.argv[3], depth, width)
+        print per_doc, peak
+        return
+
+    print 'depth=%d width=%d docs=%d' % (depth, width, DOCS)
+    for pattern in sorted(PATTERNS):
+        out = subprocess.check_output([sys.executable, __file__, str(depth),
+                                       str(width), pattern])
+        per_doc, peak = out.split()
+        print '%-14s %10.1f us/doc %10d KB peak' % (pattern,
+                                                   float(per_doc) * 1e6,
+                                                   int(peak))
+
+
+if __name__ == '__main__':
+    main()
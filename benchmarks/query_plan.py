@@ -0,0 +1,46 @@
+# -*- coding:  utf-8 -*-
+"""Compare building request path queries with and without plan cache.
+
+    python benchmarks/query_plan.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mongodbobject import Model, Manager
+from mongodbobject.query import QueryPlan, UpdatePlan, parse_query, parse_update
+
+
+class Item(Model):
+    pass
+
+
+QUERY = dict(owner__name='jack', status='active', rating__gte=3,
+             rating__lt=9, tags__in=['a', 'b'], created__gt=100)
+UPDATE = dict(set__status='done', set__owner__name='john', inc__views=1,
+              inc__rating=2, push__tags='c')
+
+manager = Manager(None, Item)
+prepared = manager.prepare(**QUERY)
+
+CASES = [
+    ('query, compiled every call', lambda: QueryPlan(QUERY).bind(QUERY)),
+    ('query, parse_query (cached)', lambda: parse_query(QUERY)),
+    ('query, Manager.prepare().bind', lambda: prepared.bind(rating__gte=4)),
+    ('update, compiled every call', lambda: UpdatePlan(UPDATE).bind(UPDATE)),
+    ('update, parse_update (cached)', lambda: parse_update(UPDATE)),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, func in CASES:
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print '%-32s %8.2f us/call' % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+# -*- coding:  utf-8 -*-
+"""Benchmark suite for model construction, query building and round trips.
+
+    python benchmarks/suite.py [options]
+
+      --profile small|medium|large   document shape, see generate.py
+      --docs N                       documents in collection
+      --mongod HOST:PORT             run round trips against mongod instead
+                                     of in-process fakedb.Database
+      --only NAME                    run cases whose name contains NAME
+      --save FILE                    store results as baseline
+      --compare FILE                 flag regressions against baseline
+      --threshold 0.15               allowed relative slowdown
+
+For every case prints throughput, latency percentiles per operation and
+number of gc tracked objects left by one operation. With --compare the
+exit status is 1 if any case regressed.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import optparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mongodbobject import Model, Manager, Field
+from mongodbobject.models import to_mongo
+from mongodbobject.query import parse_query, parse_update
+
+from fakedb import Database
+from generate import make_docs
+
+SAMPLES = 30
+SAMPLE_SECONDS = 0.005 # minimal duration of one sample
+
+
+class BenchDoc(Model):
+    pass
+
+
+class BenchUser(Model):
+    name = Field(unicode)
+    email = Field(unicode)
+    age = Field(int, default=0)
+    rank = Field(int)
+    active = Field(bool, default=True)
+    tags = Field(list, default=[])
+    profile = Field(dict, default={})
+    score = Field(float, default=0.0)
+    country = Field(unicode, default=u'de')
+    city = Field(unicode)
+
+
+QUERY = dict(name='jack', rank__gte=3, rank__lt=9, tags__in=['a', 'b'],
+             profile__city='Berlin')
+UPDATE = dict(set__name='john', set__profile__city='Paris', inc__rank=1,
+              push__tags='c')
+
+
+def touch_all(value):
+    "Read every nested value through HandyDict access"
+    if isinstance(value, dict):
+        for k in value.keys():
+            touch_all(value[k])
+    elif isinstance(value, list):
+        for v in value:
+            touch_all(v)
+    return value
+
+
+def cycle(items):
+    "Return function returning next item, starting over at the end"
+    state = {'i': -1}
+
+    def next_item():
+        state['i'] = (state['i'] + 1) % len(items)
+        return items[state['i']]
+    return next_item
+
+
+# Every case takes context and returns (operation, docs per operation)
+
+def case_handydict_construct(ctx):
+    doc = cycle(ctx['docs'])
+    return lambda: BenchDoc(doc()), 1
+
+
+def case_handydict_touch_all(ctx):
+    doc = cycle(ctx['docs'])
+    return lambda: touch_all(BenchDoc(doc())), 1
+
+
+def case_metamodel_defaults(ctx):
+    return lambda: BenchUser(name=u'jack', rank=1), 1
+
+
+def case_metamodel_field_lookup(ctx):
+    return lambda: BenchUser.rank, 1
+
+
+def case_metamodel_from_mongo(ctx):
+    doc = dict(BenchUser(name=u'jack', email=u'jack@example.com', rank=1))
+    return lambda: BenchUser._from_mongo(doc), 1
+
+
+def case_metamodel_to_mongo(ctx):
+    model = BenchUser(name=u'jack', email=u'jack@example.com', rank=1)
+    return lambda: to_mongo(model), 1
+
+
+def case_parse_query(ctx):
+    return lambda: parse_query(QUERY), 1
+
+
+def case_parse_update(ctx):
+    return lambda: parse_update(UPDATE), 1
+
+
+def case_doclist_next(ctx):
+    manager = ctx['manager']
+    return lambda: manager.find().list(), len(ctx['docs'])
+
+
+def case_doclist_one_field(ctx):
+    manager = ctx['manager']
+    return lambda: [doc.rank for doc in manager.find()], len(ctx['docs'])
+
+
+def case_doclist_lazy_one_field(ctx):
+    manager = ctx['manager']
+    return lambda: [doc.rank for doc in manager.find().lazy()], \
+        len(ctx['docs'])
+
+
+def case_manager_find_one(ctx):
+    manager = ctx['manager']
+    _id = cycle(ctx['ids'])
+    return lambda: manager.find_one(_id=_id()), 1
+
+
+def case_manager_save_new(ctx):
+    manager = ctx['scratch']
+    doc = cycle(ctx['docs'])
+
+    def save():
+        model = BenchDoc(doc())
+        model.pop('_id', None)
+        manager.save(model)
+        return model
+    return save, 1
+
+
+def case_manager_save_partial(ctx):
+    manager = ctx['manager']
+    models = cycle(list(manager.find().limit(100)))
+
+    def save():
+        model = models()
+        model.rank += 1
+        manager.save(model)
+        return model
+    return save, 1
+
+
+CASES = [(name[5:], func) for name, func in sorted(globals().items())
+         if name.startswith('case_')]
+
+
+def calibrate(op):
+    "Number of calls taking at least SAMPLE_SECONDS"
+    repeat = 1
+    while True:
+        start = time.time()
+        for i in xrange(repeat):
+            op()
+        if time.time() - start >= SAMPLE_SECONDS or repeat >= 1 << 20:
+            return repeat
+        repeat *= 2
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_case(op, docs_per_op):
+    """Return throughput, latency percentiles in microseconds per doc
+    and gc tracked objects left per doc"""
+    op() # warm up
+    repeat = calibrate(op)
+    latencies = []
+    total = 0.0
+    for i in range(SAMPLES):
+        start = time.time()
+        for j in xrange(repeat):
+            op()
+        elapsed = time.time() - start
+        total += elapsed
+        latencies.append(elapsed / (repeat * docs_per_op))
+
+    # Objects created by operation and kept by its result
+    keep = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for i in xrange(repeat):
+            keep.append(op())
+        objects = max(0, len(gc.get_objects()) - before)
+    finally:
+        gc.enable()
+
+    return {'ops_per_sec': SAMPLES * repeat * docs_per_op / total,
+            'p50_us': percentile(latencies, 50) * 1e6,
+            'p95_us': percentile(latencies, 95) * 1e6,
+            'p99_us': percentile(latencies, 99) * 1e6,
+            'objects_per_op': float(objects) / (repeat * docs_per_op)}
+
+
+def connect(address):
+    "Database for round trips, fakedb without address"
+    if not address:
+        return Database()
+    import pymongo
+    host, port = address.split(':') if ':' in address else (address, 27017)
+    return pymongo.Connection(host, int(port))['mongodbobject_benchmark']
+
+
+def compare(results, baseline, threshold):
+    "Print comparison with baseline, return names of regressed cases"
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        speed = result['ops_per_sec'] / base['ops_per_sec'] - 1
+        objects = result['objects_per_op'] - base['objects_per_op']
+        regressed = speed < -threshold or \
+            objects > max(1, base['objects_per_op'] * threshold)
+        if regressed:
+            regressions.append(name)
+        print '%-26s %+7.1f%% throughput %+8.1f objects/op %s' % (
+            name, speed * 100, objects, 'REGRESSION' if regressed else '')
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--profile', default='medium')
+    parser.add_option('--docs', type='int', default=500)
+    parser.add_option('--mongod', default=None)
+    parser.add_option('--only', default='')
+    parser.add_option('--save', default=None)
+    parser.add_option('--compare', default=None)
+    parser.add_option('--threshold', type='float', default=0.15)
+    options, args = parser.parse_args()
+
+    db = connect(options.mongod)
+    docs = make_docs(options.docs, options.profile)
+    manager = Manager(db, BenchDoc)
+    scratch = Manager(db, BenchUser)
+    manager.collection.remove({})
+    scratch.collection.remove({})
+    manager.save_many([BenchDoc(doc) for doc in docs])
+    ctx = {'docs': docs, 'manager': manager, 'scratch': scratch,
+           'ids': list(manager.find().values_list('_id', flat=True))}
+
+    print 'python %s, profile=%s docs=%d backend=%s' % (
+        platform.python_version(), options.profile, options.docs,
+        options.mongod or 'fakedb')
+    print '%-26s %12s %10s %10s %10s %10s' % (
+        'case', 'docs/s', 'p50 us', 'p95 us', 'p99 us', 'objects')
+    results = {}
+    try:
+        for name, case in CASES:
+            if options.only not in name:
+                continue
+            result = results[name] = run_case(*case(ctx))
+            print '%-26s %12.0f %10.2f %10.2f %10.2f %10.1f' % (
+                name, result['ops_per_sec'], result['p50_us'],
+                result['p95_us'], result['p99_us'], result['objects_per_op'])
+    finally:
+        if options.mongod:
+            manager.collection.drop()
+            scratch.collection.drop()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'profile': options.profile, 'docs': options.docs,
+                       'backend': options.mongod or 'fakedb',
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if (baseline['profile'], baseline['docs']) != (options.profile,
+                                                       options.docs):
+            print 'warning: baseline was run with profile=%s docs=%d' % (
+                baseline['profile'], baseline['docs'])
+        print
+        if compare(results, baseline['results'], options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
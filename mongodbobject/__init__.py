@@ -1,3 +1,11 @@
 from models import Model, MetaModel
 from manager import Manager
+from asyncmanager import AsyncManager, gather
+from indexes import Index
+from routing import Pool, Router
+from advisor import IndexAdvisor
+from aggregation import Sum, Avg, Min, Max, Count, First, Last, Push, AddToSet
+from instrument import Instrumentation
+from writebehind import WriteBehind
+from cache import IdentityMap, ResultCache, MemoryBackend, SharedBackend
 from fields import *
@@ -0,0 +1,220 @@
+"Find queries not served by indexes"
+
+import random
+import threading
+
+from indexes import Index
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists',
+                   '$regex', '$size', '$all', '$elemMatch', '$not', '$mod')
+
+# Cost of shapes without explain samples: scan, in-memory sort
+STATIC_COST = (100, 10)
+
+
+class Shape(object):
+    """Normalized query: fields compared for equality, range fields and
+    sort. Values are not part of the shape."""
+    def __init__(self, query, sort=None):
+        equality, ranges, self.has_or = set(), set(), False
+        clauses = [query or {}]
+        while clauses:
+            for key, value in clauses.pop().iteritems():
+                if key == '$and':
+                    clauses.extend(value)
+                elif key in ('$or', '$nor'):
+                    self.has_or = True
+                elif isinstance(value, dict) and value and \
+                        any(op in RANGE_OPERATORS for op in value):
+                    ranges.add(key)
+                else: # plain value or $in
+                    equality.add(key)
+        self.equality = tuple(sorted(equality))
+        self.ranges = tuple(sorted(ranges - equality))
+        self.sort = tuple((k, 1 if d > 0 else -1) for k, d in sort or ())
+
+    @property
+    def key(self):
+        return (self.equality, self.ranges, self.sort, self.has_or)
+
+    def filtered(self):
+        return set(self.equality) | set(self.ranges)
+
+    def uses(self, spec):
+        "Check if index spec can be used to select documents"
+        return bool(spec) and spec[0][0] in self.filtered()
+
+    def sorted_by(self, spec):
+        """Check if index spec returns documents in sort order: keys after
+        a prefix of equality fields are the sort keys, all in the same
+        or all in reversed direction."""
+        if not self.sort:
+            return True
+        keys = list(spec)
+        while keys and keys[0][0] in self.equality and \
+                keys[0][0] not in dict(self.sort):
+            keys.pop(0)
+        head = keys[:len(self.sort)]
+        reverse = [(k, -d) for k, d in self.sort]
+        return head in (list(self.sort), reverse)
+
+    def suggest(self):
+        "Index of equality, sort and range fields, in that order"
+        keys = [(k, 1) for k in self.equality]
+        keys.extend(s for s in self.sort if s[0] not in self.equality)
+        keys.extend((k, 1) for k in self.ranges if k not in dict(self.sort))
+        if not keys:
+            return None
+        return Index(*keys)
+
+    def __repr__(self):
+        parts = []
+        if self.equality:
+            parts.append('eq(%s)' % ', '.join(self.equality))
+        if self.ranges:
+            parts.append('range(%s)' % ', '.join(self.ranges))
+        if self.sort:
+            parts.append('sort(%s)' % ', '.join(
+                k if d > 0 else '-' + k for k, d in self.sort))
+        if self.has_or:
+            parts.append('$or')
+        return ' '.join(parts) or 'all'
+
+
+def read_plan(plan):
+    """Return (collection scan, in-memory sort, docs examined) from explain
+    output of old (cursor, scanAndOrder) or new (queryPlanner) servers"""
+    if 'queryPlanner' in plan:
+        stages = []
+        stage = plan['queryPlanner'].get('winningPlan', {})
+        while stage:
+            stages.append(stage.get('stage'))
+            stage = stage.get('inputStage')
+        examined = plan.get('executionStats', {}).get('totalDocsExamined', 0)
+        return 'COLLSCAN' in stages, 'SORT' in stages, examined
+    scan = plan.get('cursor', '').startswith('BasicCursor')
+    return scan, bool(plan.get('scanAndOrder')), plan.get('nscanned', 0)
+
+
+class ShapeStats(object):
+    "Counters of one shape of one collection"
+    def __init__(self, collection, shape, query, sort):
+        self.collection = collection
+        self.shape = shape
+        self.example = (query, sort)
+        self.count = 0
+        self.samples = 0
+        self.examined = 0
+        self.plan_scan = False
+        self.plan_sort = False
+
+
+class IndexAdvisor(object):
+    """Record shapes of queries run through managers and check them
+    against declared and server indexes. One of sample_rate queries of a
+    shape, and the first one, is explained on server. Meant for
+    development and staging, sampling costs extra queries.
+
+    advisor = IndexAdvisor(sample_rate=0.05)
+    manager = Manager(db, User, advisor=advisor)
+    ...
+    print advisor.format_report()
+    """
+    def __init__(self, sample_rate=0.01, explain=True):
+        self.sample_rate = sample_rate
+        self.explain = explain
+        self._shapes = {}
+        self._managers = {}
+        self._server_indexes = {}
+        self._lock = threading.Lock()
+
+    def record(self, manager, query, sort=None, hint=None):
+        "Record query of manager, explain it when sampled"
+        if hint:
+            return # index is chosen by caller
+        collection = manager.model_class._name
+        shape = Shape(query, sort)
+        key = (collection, shape.key)
+        with self._lock:
+            stats = self._shapes.get(key)
+            if stats is None:
+                stats = self._shapes[key] = ShapeStats(collection, shape,
+                                                       query, sort)
+            stats.count += 1
+            sample = self.explain and (stats.samples == 0 or
+                                       random.random() < self.sample_rate)
+            self._managers.setdefault(collection, manager)
+        if sample:
+            self._sample(manager, stats, query, sort)
+
+    def _sample(self, manager, stats, query, sort):
+        cursor = manager.collection.find(query)
+        if sort:
+            cursor = cursor.sort(list(sort))
+        scan, in_memory, examined = read_plan(cursor.explain())
+        with self._lock:
+            stats.samples += 1
+            stats.examined += examined
+            stats.plan_scan = stats.plan_scan or scan
+            stats.plan_sort = stats.plan_sort or in_memory
+
+    def _specs(self, collection):
+        "Key specs of declared and server indexes of collection"
+        manager = self._managers[collection]
+        server = self._server_indexes.get(collection)
+        if server is None:
+            server = self._server_indexes[collection] = [
+                [tuple(k) for k in info['key']]
+                for info in manager.collection.index_information().values()]
+        return [index.spec for index in manager.model_class._indexes] + server
+
+    def report(self):
+        """List of shapes not fully served by indexes, most expensive
+        first. Score is number of queries times cost, cost is average of
+        docs examined in explain samples."""
+        rows = []
+        for stats in self._shapes.values():
+            shape = stats.shape
+            specs = self._specs(stats.collection)
+            scan = not any(shape.uses(spec) for spec in specs) and \
+                bool(shape.filtered())
+            in_memory = bool(shape.sort) and \
+                not any(shape.sorted_by(spec) for spec in specs
+                        if shape.uses(spec) or not shape.filtered())
+            scan = scan or stats.plan_scan
+            in_memory = in_memory or stats.plan_sort
+            if not scan and not in_memory:
+                continue
+            if stats.samples:
+                cost = max(1.0, float(stats.examined) / stats.samples)
+            else:
+                cost = STATIC_COST[0 if scan else 1]
+            rows.append({'collection': stats.collection, 'shape': shape,
+                         'count': stats.count, 'scan': scan,
+                         'in_memory_sort': in_memory, 'cost': cost,
+                         'score': stats.count * cost,
+                         'suggest': None if shape.has_or else shape.suggest(),
+                         'example': stats.example})
+        rows.sort(key=lambda row: -row['score'])
+        return rows
+
+    def format_report(self):
+        "Report as text, one line per shape"
+        lines = []
+        for row in self.report():
+            problems = [name for name, flag in (('COLLSCAN', row['scan']),
+                        ('SORT', row['in_memory_sort'])) if flag]
+            suggest = row['suggest']
+            lines.append('%10.0f %6d x %-20s %-40r %-14s %s' % (
+                row['score'], row['count'], row['collection'], row['shape'],
+                '+'.join(problems),
+                'Index(%s)' % ', '.join(repr(k if d > 0 else '-' + k)
+                                        for k, d in suggest.spec)
+                if suggest else ''))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+            self._managers.clear()
+            self._server_indexes.clear()
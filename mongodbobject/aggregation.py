@@ -0,0 +1,216 @@
+"Build aggregation pipelines from queries"
+
+import copy
+
+from bson.son import SON
+from pymongo.errors import OperationFailure
+from fields import Field
+
+
+def _path(field):
+    "Dotted path of Field or django style name"
+    if isinstance(field, Field):
+        return field.name
+    return field.replace('__', '.')
+
+
+def _name(field):
+    "Name of field in result rows"
+    if isinstance(field, Field):
+        return field.name
+    return field
+
+
+def run_pipeline(collection, db, pipeline):
+    """Run pipeline with Collection.aggregate() or with aggregate command
+    of drivers without it, return list of result docs"""
+    if callable(getattr(type(collection), 'aggregate', None)):
+        result = collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            return result['result']
+        return list(result)
+    return _command(db, collection.name, pipeline)
+
+
+def _command(db, name, pipeline):
+    """Run aggregate command with cursor, required since MongoDB 3.6.
+    Servers before 2.6 know no cursor option and servers before 3.2 no
+    getMore command, they get results inline."""
+    try:
+        cursor = db.command(SON([('aggregate', name), ('pipeline', pipeline),
+                                 ('cursor', {})]))['cursor']
+        docs = list(cursor['firstBatch'])
+        while cursor['id']:
+            cursor = db.command(SON([('getMore', long(cursor['id'])),
+                                     ('collection', name)]))['cursor']
+            docs.extend(cursor['nextBatch'])
+        return docs
+    except OperationFailure, e:
+        try:
+            return db.command(SON([('aggregate', name),
+                                   ('pipeline', pipeline)]))['result']
+        except OperationFailure:
+            raise e
+
+
+class Accumulator(object):
+    "Value computed for every group, see Aggregation.annotate()"
+    operator = None
+
+    def __init__(self, field):
+        self.field = field
+
+    def compile(self):
+        return {self.operator: '$' + _path(self.field)}
+
+
+class Sum(Accumulator):
+    operator = '$sum'
+
+
+class Avg(Accumulator):
+    operator = '$avg'
+
+
+class Min(Accumulator):
+    operator = '$min'
+
+
+class Max(Accumulator):
+    operator = '$max'
+
+
+class First(Accumulator):
+    operator = '$first'
+
+
+class Last(Accumulator):
+    operator = '$last'
+
+
+class Push(Accumulator):
+    operator = '$push'
+
+
+class AddToSet(Accumulator):
+    operator = '$addToSet'
+
+
+class Count(Accumulator):
+    "Number of documents in group"
+    def __init__(self):
+        self.field = None
+
+    def compile(self):
+        return {'$sum': 1}
+
+
+class Aggregation(object):
+    """Pipeline of stages run on server, started by filter, sort, skip and
+    limit of a query. Every method returns new aggregation, results are
+    plain dicts.
+
+    query.aggregate().group_by('country').annotate(total=Sum('price'))
+    """
+    def __init__(self, query):
+        self._manager = query._manager
+        self._stages = []
+        if query._query:
+            self._stages.append(('stage', {'$match': query._query}))
+        if query._sort:
+            self._stages.append(('stage', {'$sort': SON(query._sort)}))
+        if query._skip:
+            self._stages.append(('stage', {'$skip': query._skip}))
+        if query._limit:
+            self._stages.append(('stage', {'$limit': query._limit}))
+
+    def _append(self, kind, stage):
+        aggregation = copy.copy(self)
+        aggregation._stages = self._stages + [(kind, stage)]
+        return aggregation
+
+    def group_by(self, *fields):
+        """Group documents by fields, use annotate() to compute values
+        of groups. group_by('country', 'address__city')"""
+        keys = [(_name(f), _path(f)) for f in fields]
+        return self._append('group', (keys, []))
+
+    def annotate(self, **accumulators):
+        """Add values computed for every group of previous group_by(),
+        or for all documents without it. annotate(total=Sum('price'))"""
+        accumulators = sorted(accumulators.items())
+        kind, stage = self._stages[-1] if self._stages else (None, None)
+        if kind != 'group':
+            return self._append('group', ([], accumulators))
+        aggregation = copy.copy(self)
+        keys, current = stage
+        aggregation._stages = self._stages[:-1] + [
+            ('group', (keys, current + accumulators))]
+        return aggregation
+
+    def count_by(self, *fields):
+        "Number of documents for every value of fields, most common first"
+        return self.group_by(*fields).annotate(count=Count()).sort(count=-1)
+
+    def distinct(self, *fields):
+        "Distinct values of fields, one row per combination"
+        return self.group_by(*fields)
+
+    def unwind(self, field):
+        "Output document for every item of list field"
+        return self._append('stage', {'$unwind': '$' + _path(field)})
+
+    def lookup(self, model, local, foreign='_id', name=None):
+        """Join documents of registered model with foreign field equal
+        to local field, as list under name (model name by default)."""
+        if isinstance(model, basestring):
+            collection = model
+        else:
+            collection = model._name
+        return self._append('stage', {'$lookup': {
+            'from': collection, 'localField': _path(local),
+            'foreignField': _path(foreign), 'as': name or collection}})
+
+    def match(self, **kwargs):
+        "Filter rows of previous stages, see parse_query()"
+        from query import parse_query
+        return self._append('stage', {'$match': parse_query(kwargs)})
+
+    def sort(self, **kwargs):
+        "Sort rows: sort(total=-1)"
+        sort = SON((k.replace('__', '.'), v) for k, v in kwargs.items())
+        return self._append('stage', {'$sort': sort})
+
+    def skip(self, num):
+        return self._append('stage', {'$skip': num})
+
+    def limit(self, num):
+        return self._append('stage', {'$limit': num})
+
+    @property
+    def pipeline(self):
+        "List of stages sent to server"
+        pipeline = []
+        for kind, stage in self._stages:
+            if kind != 'group':
+                pipeline.append(stage)
+                continue
+            keys, accumulators = stage
+            group = {'_id': dict((name, '$' + path) for name, path in keys)
+                            if keys else None}
+            # flatten group key into row
+            project = {'_id': 0}
+            for name, path in keys:
+                project[name] = '$_id.' + name
+            for name, accumulator in accumulators:
+                group[name] = accumulator.compile()
+                project[name] = 1
+            pipeline.append({'$group': group})
+            pipeline.append({'$project': project})
+        return pipeline
+
+    def __iter__(self):
+        return iter(self._manager._aggregate(self.pipeline))
+
+    def list(self):
+        return list(self)
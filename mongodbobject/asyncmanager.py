@@ -0,0 +1,269 @@
+"""Non-blocking Manager and Query returning futures.
+
+Operations run on a bounded pool of threads and return futures with the
+concurrent.futures interface, so an event loop does not wait for
+pymongo I/O. Tornado coroutines can yield them, asyncio can await them
+wrapped by asyncio.wrap_future(). The futures backport is used when
+installed, otherwise a minimal implementation below.
+"""
+
+import Queue
+import threading
+
+from manager import Manager
+from query import Query
+
+
+class _Future(object):
+    "Subset of concurrent.futures.Future"
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Future is not done in %s seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Future is not done in %s seconds' % timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result, self._exception = result, exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+
+class _ThreadPoolExecutor(object):
+    "Subset of concurrent.futures.ThreadPoolExecutor"
+    def __init__(self, max_workers):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        future = _Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError: # futures backport is not installed
+    Future, ThreadPoolExecutor = _Future, _ThreadPoolExecutor
+
+
+def gather(futures):
+    "Return future of list of results, fails with the first failure"
+    futures = list(futures)
+    gathered = Future()
+    state = {'left': len(futures)}
+    lock = threading.Lock()
+
+    def done(future):
+        if future.exception() is not None:
+            if not gathered.done():
+                gathered.set_exception(future.exception())
+            return
+        with lock:
+            state['left'] -= 1
+            last = state['left'] == 0
+        if last and not gathered.done():
+            gathered.set_result([f.result() for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+def _chain(name):
+    "Wrap Query method returning new query"
+    def wrapper(self, *args, **kwargs):
+        return AsyncQuery(self._manager,
+                          getattr(self._query, name)(*args, **kwargs))
+    wrapper.__name__ = name
+    return wrapper
+
+
+class AsyncQuery(object):
+    """Query of AsyncManager. Building the query does no I/O, methods
+    reading or writing documents return futures.
+
+    query = users.find(age__gt=20).sort(name=1)
+    count = yield query.count()
+    while True:
+        batch = yield query.next_batch(100)
+        if not batch:
+            break
+    """
+    def __init__(self, manager, query):
+        self._manager = manager
+        self._query = query
+        self._lock = threading.Lock() # cursor is read by one thread at once
+
+    find = _chain('find')
+    where = _chain('where')
+    sort = _chain('sort')
+    skip = _chain('skip')
+    limit = _chain('limit')
+    hint = _chain('hint')
+    batch_size = _chain('batch_size')
+    only = _chain('only')
+    defer = _chain('defer')
+    prefetch = _chain('prefetch')
+    raw = _chain('raw')
+    lazy = _chain('lazy')
+    values = _chain('values')
+    values_list = _chain('values_list')
+
+    def _submit(self, fn, *args):
+        return self._manager._executor.submit(fn, *args)
+
+    def count(self):
+        return self._submit(self._query.count)
+
+    def update(self, **kwargs):
+        return self._submit(lambda: self._query.update(**kwargs))
+
+    def remove(self):
+        return self._submit(self._query.remove)
+
+    def list(self):
+        "Future of list of all documents"
+        return self._submit(lambda: list(self._query._derive()))
+
+    def next_batch(self, num=100):
+        "Future of list of next 'num' documents, empty list at the end"
+        def read():
+            with self._lock:
+                return self._query._read_batch(num)
+        return self._submit(read)
+
+    @property
+    def query(self):
+        return self._query.query
+
+
+class AsyncManager(object):
+    """Manager running operations on pool of max_concurrency threads.
+    Other arguments are passed to Manager. Parsing of queries and updates
+    and models are the same as for Manager.
+
+    users = AsyncManager(db, User, max_concurrency=20)
+    user = yield users.find_one(name='jack')
+    """
+    def __init__(self, connection, model_or_class, max_concurrency=10,
+                 executor=None, **kwargs):
+        self.manager = Manager(connection, model_or_class, **kwargs)
+        self.model_class = self.manager.model_class
+        self._executor = executor or ThreadPoolExecutor(max_concurrency)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        return self._executor.submit(fn, *args)
+
+    def find(self, **kwargs):
+        return AsyncQuery(self, Query(self.manager, {}, **kwargs))
+
+    def where(self, *expressions):
+        return AsyncQuery(self, self.manager.where(*expressions))
+
+    def query(self, **kwargs):
+        return AsyncQuery(self, self.manager.query(**kwargs))
+
+    def find_one(self, **kwargs):
+        return self._submit(lambda: self.manager.find_one(**kwargs))
+
+    def save(self, model):
+        return self._submit(self.manager.save, model)
+
+    def save_many(self, models, **kwargs):
+        return self._submit(lambda: self.manager.save_many(models, **kwargs))
+
+    def delete(self, model):
+        return self._submit(self.manager.delete, model)
+
+    def dereference_many(self, dbrefs):
+        "Future of list of models, one query per collection"
+        return self._submit(self.manager.dereference_many, dbrefs)
+
+    def dereference(self, dbref):
+        """Future of referenced model. References requested while
+        a batch is waiting for a thread are resolved together, so
+        gathering many dereference() calls costs one query."""
+        future = Future()
+        with self._lock:
+            self._pending.append((dbref, future))
+            first = len(self._pending) == 1
+        if first:
+            self._submit(self._dereference_pending)
+        return future
+
+    def _dereference_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        try:
+            models = self.manager.dereference_many([r for r, f in pending])
+        except Exception, e:
+            for dbref, future in pending:
+                future.set_exception(e)
+            return
+        for (dbref, future), model in zip(pending, models):
+            future.set_result(model)
+
+    def shutdown(self, wait=True):
+        "Stop threads of executor"
+        self._executor.shutdown(wait)
@@ -0,0 +1,232 @@
+"Define IdentityMap class"
+
+import time
+import threading
+from collections import OrderedDict
+
+from bson import BSON
+
+
+class IdentityMap(object):
+    """Bounded map of loaded models keyed on (collection, _id).
+    Least recently used entries are evicted first, entries older
+    than ttl seconds are treated as missing.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, collection, _id):
+        "Return cached model or None"
+        key = (collection, _id)
+        with self._lock:
+            try:
+                model, stored = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self._items[key] = (model, stored) # move to the end
+            self.hits += 1
+            return model
+
+    def put(self, collection, _id, model):
+        "Store model, evict least recently used if full"
+        key = (collection, _id)
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (model, time.time())
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection, _id=None):
+        "Forget one document or, without _id, the whole collection"
+        with self._lock:
+            if _id is not None:
+                self._items.pop((collection, _id), None)
+                return
+            for key in [k for k in self._items if k[0] == collection]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    @property
+    def stats(self):
+        "Counters for sizing the map"
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._items)}
+
+    def __len__(self):
+        return len(self._items)
+
+
+def freeze(value):
+    "Convert query value into hashable key, dict keys are sorted"
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return ('list',) + tuple(freeze(v) for v in value)
+    return value
+
+
+class MemoryBackend(object):
+    "In-process store for ResultCache, least recently used entries go first"
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, stored = self._items.pop(key)
+            except KeyError:
+                return None
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.evictions += 1
+                return None
+            self._items[key] = (value, stored)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time())
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, collection):
+        return self._generations.get(collection, 0)
+
+    def bump(self, collection):
+        with self._lock:
+            self._generations[collection] = self.generation(collection) + 1
+
+
+class SharedBackend(object):
+    """Store for ResultCache shared by worker processes forked after its
+    creation. Entries live in multiprocessing manager process, so every
+    access is a local round trip; oldest tenth is dropped when full."""
+    def __init__(self, size=1000, ttl=None, manager=None):
+        import multiprocessing
+        self.size = size
+        self.ttl = ttl
+        self.evictions = 0
+        self._manager = manager or multiprocessing.Manager()
+        self._items = self._manager.dict()
+        self._generations = self._manager.dict()
+        self._lock = self._manager.Lock()
+
+    def get(self, key):
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        value, stored = entry
+        if self.ttl is not None and time.time() - stored > self.ttl:
+            self.evictions += 1
+            return None
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (value, time.time())
+        if len(self._items) > self.size:
+            items = sorted(self._items.items(), key=lambda item: item[1][1])
+            for k, entry in items[:max(1, self.size // 10)]:
+                self._items.pop(k, None)
+                self.evictions += 1
+
+    def generation(self, collection):
+        return self._generations.get(collection, 0)
+
+    def bump(self, collection):
+        with self._lock:
+            self._generations[collection] = self.generation(collection) + 1
+
+
+class ResultCache(object):
+    """Cache of query results and counts for Manager.
+    Entries are keyed on collection generation which is bumped by every
+    write through Manager, so stale results are never returned for
+    writes made through the same backend. Results over max_docs
+    documents are not cached.
+    """
+    def __init__(self, backend=None, max_docs=1000):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.max_docs = max_docs
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, collection, parts):
+        """Return key for current generation of collection.
+        Take it before reading from db so results read during a write
+        are stored under the old generation."""
+        return (collection, self.backend.generation(collection), freeze(parts))
+
+    def get(self, key):
+        "Return cached value or None"
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.backend.set(key, value)
+
+    def bump(self, collection):
+        "Invalidate all results of collection"
+        self.backend.bump(collection)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.backend.evictions}
+
+
+class RecordingCursor(object):
+    """Pass docs of cursor through, store them in cache when exhausted.
+    Docs are stored encoded to BSON, so changes made by their readers do
+    not reach the cache."""
+    def __init__(self, cursor, cache, key):
+        self._cursor = cursor
+        self._cache = cache
+        self._key = key
+        self._docs = []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            doc = self._cursor.next()
+        except StopIteration:
+            if self._docs is not None:
+                self._cache.put(self._key, self._docs)
+                self._docs = None
+            raise
+        if self._docs is not None:
+            if len(self._docs) < self._cache.max_docs:
+                self._docs.append(doc if isinstance(doc, str)
+                                  else BSON.encode(doc))
+            else:
+                self._docs = None # too big to cache
+        return doc
+
+    def __getattr__(self, k):
+        return getattr(self._cursor, k)
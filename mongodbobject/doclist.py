@@ -1,70 +1,379 @@
+import sys
+import copy
+import Queue
+import threading
+from collections import deque
+from itertools import islice
+
 import pymongo
+from bson import BSON
+from cache import RecordingCursor
+from instrument import InstrumentedCursor
+from lazy import RawDocs, lazy_doc
+from models import MongoModels
 
 class DocList(object):
     """Represents a list of documents that are iteratable. 
     Objectifying the documents is lazy. Every doc gets converted to 
     an object if it's requested through the iterator.
     """
+    # Number of docs dereferenced together when prefetch is used
+    prefetch_batch = 100
+
     def __init__(self, manager, items):
         """Initialize DocList using the manager it belongs to and
         the items as iterator.
         """
         self._litems = items
         self._manager = manager
+        self._prefetch = ()
+        self._fields = None
+        self._row = None # converts docs to plain rows instead of models
+        self._lazy = False # read raw BSON, see Query.lazy()
+        self._sort = None
+        self._skip = None
+        self._limit = None
+        self._hint = None
+        self._batch_size = None
+        self._route = None
+        self._materialize = None # max number of memoized docs
+        self._buffer = deque()
+        self._results = []
+        self._exhausted = False
+        self._iterator = None
 
     @property
     def _items(self):
         """For use in query"""
         if self._litems == None:
-            self._litems = self._manager._find(self._query)
+            self._litems = self._open()
         return self._litems
+
+    def _open(self):
+        "Create cursor or iterate over cached results"
+        cache = self._manager.result_cache
+        if cache is not None:
+            key = cache.key(self._manager.model_class._name,
+                            (self._query, self._fields, self._sort,
+                             self._skip, self._limit, self._hint,
+                             self._lazy))
+            docs = cache.get(key)
+            if docs is not None:
+                if self._lazy and self._row is None:
+                    return iter(docs)
+                return (BSON(doc).decode() for doc in docs)
+
+        if self._manager.advisor is not None:
+            self._manager.advisor.record(self._manager, self._query,
+                                         self._sort, self._hint)
+        cursor = None
+        if self._lazy and self._row is None:
+            cursor = self._manager._find_raw(self._query, self._fields)
+        if cursor is not None:
+            cursor = RawDocs(self._cursor(cursor))
+        else:
+            cursor = self._cursor(self._manager._find(self._query,
+                                                      self._fields,
+                                                      self._route))
+        instrumentation = self._manager.instrumentation
+        if instrumentation is not None:
+            cursor = InstrumentedCursor(cursor, instrumentation,
+                                        self._manager.model_class._name,
+                                        self._query)
+        if cache is not None:
+            return RecordingCursor(cursor, cache, key)
+        return cursor
+
+    def _cursor(self, cursor):
+        "Apply sort, skip, limit and hint options to cursor"
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._skip:
+            cursor = cursor.skip(self._skip)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        if self._hint:
+            cursor = cursor.hint(self._hint)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        return cursor
     
     def __iter__(self):
         """Iterator
         """
-        return self
-    
+        if self._materialize is None:
+            return self
+        return self._iter_results()
+
+    def _derive(self, **options):
+        """Return copy of list with changed options.
+        Lists of a query create their cursor lazily."""
+        doclist = copy.copy(self)
+        doclist._buffer = deque()
+        doclist._results = []
+        doclist._exhausted = False
+        doclist._iterator = None
+        for k, v in options.iteritems():
+            setattr(doclist, '_' + k, v)
+        if hasattr(self, '_query'):
+            doclist._litems = None
+        else:
+            doclist._litems = doclist._cursor(self._litems)
+        return doclist
+
     def skip(self, num):
         """Skip 'num' docs starting at the beginning.
         """
-        return DocList(self._manager, self._items().skip(num))
+        return self._derive(skip=num)
         
     def limit(self, num):
         """Limit result list to 'num' docs.
         """
-        return DocList(self._manager, self._items.limit(num))
+        return self._derive(limit=num)
         
     def sort(self, **kwargs):
         """Sort result on key.
         sort(name=1, person__gender=1)  =>  {'name': 1, 'person.gender': 1}
         """
         sort = [(k.replace('__', '.'), v) for k, v in kwargs.items()]
-        return DocList(self._manager, self._items.sort(sort))
+        return self._derive(sort=sort)
 
     def hint(self, *fields):
         """Make hint to DB.
         Use DocList.hint(Model.field1, Model.field2) form"""
         hint = [(f.name, f.order) for f in fields]
-        return DocList(self._manager, self._items.hint(hint))
+        return self._derive(hint=hint)
         
+    def batch_size(self, num):
+        """Set number of docs returned by server in one network round trip.
+        """
+        return self._derive(batch_size=num)
+
+    def route(self, kind):
+        """Read docs from pools of kind when manager uses Router,
+        e.g. route('scan') for heavy scans kept off read replicas.
+        """
+        return self._derive(route=kind)
+
+    def materialize(self, max_docs=1000):
+        """Keep converted docs of the first iteration, so the list can be
+        iterated again, measured with len(), indexed and sliced without
+        new queries. Lists over max_docs docs are not kept, they fall back
+        to streaming and every iteration queries db again.
+        """
+        return self._derive(materialize=max_docs)
+
+    def _iter_results(self):
+        "Iterate over memoized docs, read more from cursor when needed"
+        i = 0
+        while self._results is not None:
+            results = self._results
+            if i < len(results):
+                yield results[i]
+                i += 1
+                continue
+            if self._exhausted:
+                return
+            batch = self._read_batch(self.prefetch_batch)
+            if not batch:
+                self._exhausted = True
+                return
+            if len(results) + len(batch) > self._materialize:
+                # Too many docs, stream the rest of the cursor
+                self._results = None
+                while batch:
+                    for item in batch:
+                        yield item
+                    batch = self._read_batch(self.prefetch_batch)
+                return
+            results.extend(batch)
+
+        # Memoized docs were dropped, query again
+        for item in islice(self._derive(materialize=None), i, None):
+            yield item
+
+    def _fill(self, num=None):
+        "Memoize first 'num' docs, all if None"
+        if num is not None and num <= 0:
+            return
+        for i, item in enumerate(self._iter_results()):
+            if i + 1 == num or self._results is None:
+                return
+
+    def __getitem__(self, index):
+        """Doc at index or list of docs in slice. Memoized lists are
+        served from memory, other lists run query with skip and limit.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step
+        else:
+            start, stop, step = index, index + 1, None
+
+        if self._materialize is not None and self._results is not None:
+            self._fill(None if start < 0 or stop is None or stop < 0 else stop)
+            if self._results is not None:
+                return self._results[index]
+
+        if start < 0 or (stop is not None and stop < 0):
+            raise IndexError('negative index needs materialize()')
+        if isinstance(index, slice):
+            return list(self._slice(start, stop))[::step]
+        docs = list(self._slice(start, stop))
+        if not docs:
+            raise IndexError('list index out of range')
+        return docs[0]
+
+    def _slice(self, start, stop):
+        "Query docs between start and stop, respecting skip and limit"
+        limit = None if stop is None else max(stop - start, 0)
+        if self._limit:
+            left = max(self._limit - start, 0)
+            limit = left if limit is None else min(limit, left)
+        if limit == 0: # limit(0) means no limit to db
+            return []
+        return self._derive(skip=(self._skip or 0) + start, limit=limit,
+                            materialize=None)
+
+    def iter_batches(self, num=None, prefetch=1):
+        """Iterate over lists of 'num' docs, one list per network batch.
+        Up to 'prefetch' next batches are read and converted on background
+        thread while current one is processed, 0 disables the thread.
+        """
+        num = num or self._batch_size or self.prefetch_batch
+        doclist = self._derive(batch_size=num)
+
+        if not prefetch:
+            while True:
+                batch = doclist._read_batch(num)
+                if not batch:
+                    return
+                yield batch
+
+        queue = Queue.Queue(prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def produce():
+            try:
+                while not stop.is_set():
+                    batch = doclist._read_batch(num)
+                    put((batch, None))
+                    if not batch:
+                        return
+            except Exception:
+                put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch, error = queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if not batch:
+                    return
+                yield batch
+        finally:
+            stop.set()
+
     def __len__(self):
-        """Number of results.
+        """Number of results. Memoized lists are counted in memory.
         """
+        if self._materialize is not None and self._results is not None:
+            self._fill()
+            if self._results is not None:
+                return len(self._results)
         return self.count()
         
     def count(self):
         """Number of results.
         """
-        return self._items.count()
+        if not hasattr(self, '_query'):
+            return self._items.count()
+        cache = self._manager.result_cache
+        if cache is None:
+            return self._manager._count(self._query)
+
+        key = cache.key(self._manager.model_class._name, ('count', self._query))
+        count = cache.get(key)
+        if count is None:
+            count = self._manager._count(self._query)
+            cache.put(key, count)
+        return count
     
     def next(self):
         """Iterator
         """
+        if self._materialize is not None:
+            if self._iterator is None:
+                self._iterator = self._iter_results()
+            return self._iterator.next()
+
+        if self._row is not None:
+            return self._row(self._items.next())
+
+        if self._prefetch:
+            if not self._buffer:
+                self._fill_buffer()
+            if not self._buffer:
+                raise StopIteration
+            return self._buffer.popleft()
+
         try:
-            return self._manager.model_class(self._items.next())
+            return self._to_model(self._items.next())
         except StopIteration:
             raise StopIteration
 
+    def _to_model(self, doc):
+        "Convert loaded doc to model"
+        instrumentation = self._manager.instrumentation
+        if instrumentation is None:
+            return self._build_model(doc)
+        return instrumentation.measure(self._manager.model_class._name,
+                                       'construct', None,
+                                       lambda: self._build_model(doc))
+
+    def _build_model(self, doc):
+        if type(doc) is str:
+            doc = lazy_doc(doc)
+        if not self._fields:
+            return self._manager.model_class._from_mongo(doc)
+
+        # Fields skipped by projection are loaded on first access
+        fields = dict((k, 0 if v else 1) for k, v in self._fields.iteritems()
+                      if k != '_id')
+        manager, _id = self._manager, doc.get('_id')
+        return manager.model_class._from_mongo(
+            doc, lambda: manager._find_fields(_id, fields))
+
+    def _fill_buffer(self):
+        "Read next batch of docs and resolve their references at once"
+        self._buffer.extend(self._read_batch(self.prefetch_batch))
+
+    def _read_batch(self, num):
+        "Read up to 'num' docs and convert them"
+        return self._convert(list(islice(self._items, num)))
+
+    def _convert(self, docs):
+        "Convert loaded docs to rows or models"
+        if self._row is not None:
+            return [self._row(doc) for doc in docs]
+
+        models = [self._to_model(doc) for doc in docs]
+        if self._prefetch:
+            manager = self._manager
+            manager._measure('prefetch', None, lambda: MongoModels.prefetch(
+                manager._db, models, self._prefetch, manager.identity_map))
+        return models
+
     def list(self):
         return list(self)
 
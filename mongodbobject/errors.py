@@ -1,3 +1,23 @@
 
 class DatabaseError(Exception):
     pass
+
+
+class BulkWriteError(DatabaseError):
+    """Raised by Manager.save_many() and upsert_many() when batches fail.
+    errors is list of (batch number, models not stored, exception)."""
+    def __init__(self, errors):
+        super(BulkWriteError, self).__init__('%d batch(es) failed' % len(errors))
+        self.errors = errors
+
+
+class ValidationError(DatabaseError):
+    "Raised when value of field has wrong type and can not be converted"
+
+
+class QueueFull(DatabaseError):
+    "Raised when write-behind queue is full"
+
+
+class PoolTimeout(DatabaseError):
+    "Raised when no slot of connection pool is free in time"
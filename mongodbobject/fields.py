@@ -1,13 +1,144 @@
 "Define Field class"
 
+import copy
+
 import pymongo
+from pymongo.dbref import DBRef
+from errors import ValidationError
+
+OPERATORS = {'<': '$lt', '<=': '$lte', '!=': '$ne', '>': '$gt', '>=': '$gte'}
+
+# Types accepted by fields of type other than the type itself
+ACCEPTS = {int: (int, long), long: (int, long), float: (float, int, long),
+           str: basestring, unicode: basestring}
+
+
+def _values(doc, path):
+    "Values by dotted path, lists are searched like mongo does"
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for v in values:
+            if isinstance(v, list):
+                v = [x.get(part) for x in v if isinstance(x, dict)]
+                found.extend(x for x in v if x is not None)
+            elif isinstance(v, dict) and part in v:
+                found.append(v[part])
+        values = found
+    return values
+
+
+def _compare(op, value, other):
+    "Compare one value like mongo operator does"
+    if op == '=':
+        return value == other or (isinstance(value, list) and other in value)
+    if isinstance(value, list):
+        return any(_compare(op, v, other) for v in value)
+    if op == '<':
+        return value < other
+    if op == '<=':
+        return value <= other
+    if op == '>':
+        return value > other
+    return value >= other
+
+
+class Expression(object):
+    """Immutable filter built from Field comparisons.
+    Combine with & and |, compile() returns mongo filter, matches(doc)
+    tests model or dict in memory without query to db."""
+    __slots__ = ('_compiled',)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def compile(self):
+        "Return copy of mongo filter, callers may modify it"
+        return copy.deepcopy(self._filter())
+
+    def _filter(self):
+        "Mongo filter built once, it must not be modified"
+        try:
+            return self._compiled
+        except AttributeError:
+            compiled = self._compile()
+            object.__setattr__(self, '_compiled', compiled)
+            return compiled
+
+    def __setattr__(self, k, v):
+        raise AttributeError('Expression is immutable')
+
 
-class CompareOp(object):
+class CompareOp(Expression):
     "Compare operation representation"
+    __slots__ = ('name', 'op', 'other')
+
     def __init__(self, name, op, other):
-        self.name = name
-        self.op = op
-        self.other = other
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'op', op)
+        object.__setattr__(self, 'other', other)
+
+    def _compile(self):
+        if self.op == '=':
+            return {self.name: self.other}
+        return {self.name: {OPERATORS[self.op]: self.other}}
+
+    def matches(self, doc):
+        values = _values(doc, self.name)
+        if self.op == '!=':
+            return not any(_compare('=', v, self.other) for v in values)
+        if not values:
+            return self.op == '=' and self.other is None
+        return any(_compare(self.op, v, self.other) for v in values)
+
+
+class And(Expression):
+    "All expressions match"
+    __slots__ = ('items',)
+
+    def __init__(self, *items):
+        flat = []
+        for item in items:
+            flat.extend(item.items if isinstance(item, And) else [item])
+        object.__setattr__(self, 'items', tuple(flat))
+
+    def _compile(self):
+        q = {}
+        for item in self.items:
+            for k, v in item._filter().iteritems():
+                if k not in q:
+                    q[k] = v
+                elif (isinstance(q[k], dict) and isinstance(v, dict) and
+                      not set(q[k]) & set(v) and
+                      all(op.startswith('$') for op in v)):
+                    q[k] = dict(q[k])
+                    q[k].update(v) # age > 1 & age < 5
+                else:
+                    return {'$and': [i._filter() for i in self.items]}
+        return q
+
+    def matches(self, doc):
+        return all(item.matches(doc) for item in self.items)
+
+
+class Or(Expression):
+    "Any of expressions matches"
+    __slots__ = ('items',)
+
+    def __init__(self, *items):
+        flat = []
+        for item in items:
+            flat.extend(item.items if isinstance(item, Or) else [item])
+        object.__setattr__(self, 'items', tuple(flat))
+
+    def _compile(self):
+        return {'$or': [item._filter() for item in self.items]}
+
+    def matches(self, doc):
+        return any(item.matches(doc) for item in self.items)
 
 class Field(object):
     "Field object for construct lookups"
@@ -23,8 +154,31 @@ class Field(object):
         self.default = default
         self.order = order
 
+    def coerce(self, value):
+        """Return value converted to type of field: ints to float, str to
+        unicode. Fields of model type take DBRefs too. None is allowed,
+        ValidationError is raised for other values."""
+        if value is None or type(value) is self.type:
+            return value
+        if isinstance(value, ACCEPTS.get(self.type, self.type)):
+            if self.type is float:
+                return float(value)
+            if self.type is unicode and isinstance(value, str):
+                try:
+                    return value.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValidationError('%s is not utf-8: %r' % (
+                        self.name, value))
+            return value
+        if isinstance(value, DBRef) and issubclass(self.type, dict):
+            return value
+        raise ValidationError('%s must be %s, not %r' % (
+            self.name, self.type.__name__, value))
+
     def process_model(self, model):
-        # Set field default value
+        """Set default value of field. Models set defaults of their fields
+        without calling it, overriding methods are called when a model
+        is created or loaded from db."""
         if self.default != None and not self.name in model:
             if isinstance(self.default, (list, dict)):
                 model[self.name] = self.type(self.default)
@@ -0,0 +1,91 @@
+"Declarative indexes of models"
+
+from fields import Field
+
+# Index options: attribute, name used by server, default
+OPTIONS = (('unique', 'unique', False), ('sparse', 'sparse', False),
+           ('ttl', 'expireAfterSeconds', None),
+           ('partial', 'partialFilterExpression', None))
+
+
+def _key(key):
+    "Normalize index key: 'name', '-name', 'a__b', Field or (key, direction)"
+    if isinstance(key, Field):
+        return (key.name, key.order or 1)
+    if isinstance(key, tuple):
+        name, direction = key
+        if isinstance(name, Field):
+            name = name.name
+        return (name.replace('__', '.'), direction)
+    if key.startswith('-'):
+        return (key[1:].replace('__', '.'), -1)
+    return (key.replace('__', '.'), 1)
+
+
+class Index(object):
+    """Index of model, declared in _indexes of model class and built by
+    Manager.ensure_indexes().
+
+    class User(Model):
+        _indexes = [Index('email', unique=True),
+                    Index('country', '-created'),
+                    Index('session__started', ttl=3600),
+                    Index('referrer', sparse=True),
+                    Index('status', partial={'status': 'active'})]
+    """
+    def __init__(self, *keys, **options):
+        self.keys = keys
+        self.unique = options.pop('unique', False)
+        self.sparse = options.pop('sparse', False)
+        self.ttl = options.pop('ttl', None)
+        self.partial = options.pop('partial', None)
+        self._name = options.pop('name', None)
+        if options:
+            raise TypeError('unknown index options: %s' % ', '.join(options))
+
+    @property
+    def spec(self):
+        "List of (key, direction)"
+        return [_key(k) for k in self.keys]
+
+    @property
+    def name(self):
+        "Given name or name generated the same way as by pymongo"
+        return self._name or '_'.join('%s_%s' % k for k in self.spec)
+
+    def options(self):
+        "Options of the index that differ from defaults, in server names"
+        options = {}
+        for attr, server_name, default in OPTIONS:
+            value = getattr(self, attr)
+            if value != default:
+                options[server_name] = value
+        return options
+
+    def matches(self, info):
+        "Check if index_information() entry has the same keys"
+        return [tuple(k) for k in info['key']] == self.spec
+
+    def same_options(self, info):
+        "Check if options of index_information() entry are the same"
+        return all(info.get(server_name, default) == getattr(self, attr)
+                   for attr, server_name, default in OPTIONS)
+
+    def __repr__(self):
+        return 'Index(%s)' % self.name
+
+
+def diff_indexes(indexes, information):
+    """Compare declared indexes with collection.index_information().
+    Return (missing, conflicts), conflicts are (index, existing name)
+    pairs of indexes with the same keys but other options."""
+    missing, conflicts = [], []
+    for index in indexes:
+        for name, info in information.iteritems():
+            if index.matches(info):
+                if not index.same_options(info):
+                    conflicts.append((index, name))
+                break
+        else:
+            missing.append(index)
+    return missing, conflicts
@@ -0,0 +1,253 @@
+"Measure latency and volume of database operations"
+
+import time
+import threading
+from bisect import bisect_left
+from collections import deque
+
+from bson import BSON
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def one(doc):
+    "Documents returned by find_one() style call"
+    return [] if doc is None else [doc]
+
+
+def shape(query):
+    """Replace values of query with '?', keep keys and operators.
+    {'age': {'$gt': 20}, 'name': 'jack'}  =>  {'age': {'$gt': '?'}, 'name': '?'}
+    """
+    if isinstance(query, list): # aggregation pipeline
+        return [shape(stage) for stage in query]
+    if isinstance(query, dict):
+        result = {}
+        for k, v in query.iteritems():
+            if k in ('$and', '$or', '$nor') and isinstance(v, list):
+                result[k] = [shape(item) for item in v]
+            elif isinstance(v, dict) and k.startswith('$'):
+                result[k] = shape(v)
+            elif isinstance(v, dict) and v and all(
+                    isinstance(op, basestring) and op.startswith('$') for op in v):
+                result[k] = shape(v)
+            else:
+                result[k] = '?'
+        return result
+    return '?'
+
+
+class Histogram(object):
+    "Counts of values in fixed buckets, values over the last one go to overflow"
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        "Upper bound of bucket containing p-th percentile"
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class OperationStats(object):
+    "Totals of one operation of one model"
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.docs = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        latency = self.latency
+        return {'calls': latency.count, 'errors': self.errors,
+                'docs': self.docs, 'bytes': self.bytes,
+                'total': latency.total, 'max': latency.max,
+                'p50': latency.percentile(50), 'p95': latency.percentile(95),
+                'p99': latency.percentile(99)}
+
+
+class Operation(object):
+    """Operation passed to hooks. seconds, docs, bytes and error are set
+    when the operation is finished."""
+    def __init__(self, model, name, spec):
+        self.model = model
+        self.name = name
+        self.spec = spec
+        self.seconds = None
+        self.docs = 0
+        self.bytes = 0
+        self.error = None
+
+
+class Instrumentation(object):
+    """Collect per model and operation latency histograms, document and
+    byte counts. Operations slower than slow_ms are kept in slow_log with
+    query shape and, for reads, explain plan of the query.
+
+    Hooks registered with add_pre_hook()/add_post_hook() get Operation
+    before and after every operation, e.g. to export metrics.
+    Sizes of documents are measured only with measure_bytes, because
+    documents have to be encoded again.
+    """
+    def __init__(self, slow_ms=100, slow_log_size=100, explain=True,
+                 measure_bytes=False):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.measure_bytes = measure_bytes
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.pre_hooks = []
+        self.post_hooks = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add_pre_hook(self, hook):
+        self.pre_hooks.append(hook)
+        return hook
+
+    def add_post_hook(self, hook):
+        self.post_hooks.append(hook)
+        return hook
+
+    def size(self, doc):
+        "Encoded size of doc if measured, else 0"
+        if not self.measure_bytes or doc is None:
+            return 0
+        if type(doc) is str: # raw BSON
+            return len(doc)
+        return len(BSON.encode(doc))
+
+    def start(self, model, name, spec=None):
+        "Create Operation and call pre hooks"
+        operation = Operation(model, name, spec)
+        for hook in self.pre_hooks:
+            hook(operation)
+        return operation
+
+    def finish(self, operation, seconds, explain=None):
+        """Record finished operation. explain() returns plan of the query,
+        it is called only for slow operations."""
+        operation.seconds = seconds
+        key = (operation.model, operation.name)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = OperationStats()
+            stats.latency.add(seconds)
+            stats.docs += operation.docs
+            stats.bytes += operation.bytes
+            if operation.error is not None:
+                stats.errors += 1
+
+        if seconds * 1000 >= self.slow_ms:
+            entry = {'model': operation.model, 'op': operation.name,
+                     'shape': shape(operation.spec), 'ms': seconds * 1000,
+                     'docs': operation.docs, 'time': time.time()}
+            if self.explain and explain is not None:
+                try:
+                    entry['plan'] = explain()
+                except Exception, e:
+                    entry['plan'] = {'error': str(e)}
+            self.slow_log.append(entry)
+
+        for hook in self.post_hooks:
+            hook(operation)
+
+    def measure(self, model, name, spec, call, written=None, returned=None,
+                explain=None):
+        """Run call() as operation and return its result. written is list
+        of documents sent, returned(result) gives list of documents read."""
+        operation = self.start(model, name, spec)
+        if written is not None:
+            operation.docs = len(written)
+            operation.bytes = sum(self.size(doc) for doc in written)
+        start = time.time()
+        try:
+            result = call()
+        except Exception, e:
+            operation.error = e
+            self.finish(operation, time.time() - start)
+            raise
+        seconds = time.time() - start
+        if returned is not None:
+            docs = returned(result)
+            operation.docs += len(docs)
+            operation.bytes += sum(self.size(doc) for doc in docs)
+        self.finish(operation, seconds, explain)
+        return result
+
+    def stats(self):
+        "Return {(model, operation): dict of totals and percentiles}"
+        with self._lock:
+            return dict((key, stats.as_dict())
+                        for key, stats in self._stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_log.clear()
+
+
+class InstrumentedCursor(object):
+    """Pass docs of cursor through, record time spent waiting for them.
+    The read is recorded when cursor is exhausted or dropped, reads of
+    dropped cursors are logged without explain plan."""
+    def __init__(self, cursor, instrumentation, model, spec):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+        self._operation = None
+        self._seconds = 0.0
+        self._operation = instrumentation.start(model, 'find', spec)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            doc = self._cursor.next()
+        except StopIteration:
+            self._seconds += time.time() - start
+            self._finish()
+            raise
+        except Exception, e:
+            self._seconds += time.time() - start
+            self._operation.error = e
+            self._finish()
+            raise
+        self._seconds += time.time() - start
+        self._operation.docs += 1
+        self._operation.bytes += self._instrumentation.size(doc)
+        return doc
+
+    def _finish(self, explain=True):
+        operation, self._operation = self._operation, None
+        if operation is not None:
+            self._instrumentation.finish(
+                operation, self._seconds,
+                self._cursor.explain if explain else None)
+
+    def __del__(self):
+        # no round trips to db during garbage collection
+        self._finish(explain=False)
+
+    def __getattr__(self, k):
+        return getattr(self._cursor, k)
@@ -0,0 +1,220 @@
+"""Documents kept as raw BSON, values are decoded on first access.
+
+Only the top level of a document is indexed: names and offsets of its
+elements are read without decoding values, so reading a few fields of
+a large document costs little. Each value is decoded by the C extension
+of bson from a one element document.
+"""
+
+import struct
+
+from bson import BSON
+from bson.son import SON
+from pymongo import helpers, message
+from pymongo.errors import AutoReconnect, OperationFailure
+
+# Sizes of fixed size values by element type
+FIXED = {'\x01': 8, '\x06': 0, '\x07': 12, '\x08': 1, '\x09': 8, '\x0a': 0,
+         '\x10': 4, '\x11': 8, '\x12': 8, '\x13': 16, '\xff': 0, '\x7f': 0}
+
+# Types of values starting with int32 size: size not including itself
+# (string, code, symbol, binary without subtype byte) or including it
+# (document, array, code with scope)
+SIZED = {'\x02': 4, '\x0d': 4, '\x0e': 4, '\x05': 5,
+         '\x03': 0, '\x04': 0, '\x0f': 0}
+
+_int32 = struct.Struct('<i')
+_reply = struct.Struct('<iqii') # flags, cursor id, starting from, returned
+
+
+def _value_end(data, kind, pos):
+    "Offset after value of element type kind starting at pos"
+    size = FIXED.get(kind)
+    if size is not None:
+        return pos + size
+    extra = SIZED.get(kind)
+    if extra is not None:
+        return pos + extra + _int32.unpack_from(data, pos)[0]
+    if kind == '\x0b': # regex: pattern and flags cstrings
+        return data.index('\x00', data.index('\x00', pos) + 1) + 1
+    if kind == '\x0c': # db pointer: string and ObjectId
+        return pos + 4 + _int32.unpack_from(data, pos)[0] + 12
+    raise ValueError('unknown BSON element type %r' % kind)
+
+
+class RawValue(object):
+    "Undecoded value of one element of BSON document"
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def decode(self):
+        element = self.data[self.start:self.end]
+        doc = BSON(_int32.pack(len(element) + 5) + element + '\x00').decode()
+        return doc.itervalues().next()
+
+    def __repr__(self):
+        return '<raw %d bytes>' % (self.end - self.start)
+
+
+def lazy_doc(data):
+    """Dict of RawValues of top level elements of BSON document, _id is
+    decoded at once"""
+    doc = {}
+    pos, end = 4, len(data) - 1
+    while pos < end:
+        kind = data[pos]
+        name_end = data.index('\x00', pos + 1)
+        value_end = _value_end(data, kind, name_end + 1)
+        doc[data[pos + 1:name_end].decode('utf-8')] = \
+            RawValue(data, pos, value_end)
+        pos = value_end
+    if '_id' in doc:
+        doc['_id'] = doc['_id'].decode()
+    return doc
+
+
+class RawDocs(object):
+    """Split batches of raw batch cursor, e.g. find_raw_batches() of
+    pymongo, into BSON documents"""
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._data = ''
+        self._pos = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._pos >= len(self._data):
+            self._data, self._pos = self._cursor.next(), 0
+        pos = self._pos
+        self._pos = pos + _int32.unpack_from(self._data, pos)[0]
+        return self._data[pos:self._pos]
+
+    def __getattr__(self, k):
+        return getattr(self._cursor, k)
+
+
+class RawBatchCursor(object):
+    """find_raw_batches() for drivers without it, e.g. pymongo 1.x.
+    Sends the query and getmore messages of pymongo Cursor and returns
+    documents of each reply as one undecoded string."""
+    def __init__(self, collection, spec=None, fields=None):
+        if isinstance(fields, list):
+            fields = helpers._fields_list_to_dict(fields)
+        self._collection = collection
+        self._spec = spec or {}
+        self._fields = fields or None
+        self._ordering = None
+        self._hint = None
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+        self._id = None
+        self._connection_id = None
+        self._retrieved = 0
+        self._killed = False
+
+    def sort(self, key_or_list, direction=None):
+        keys = helpers._index_list(key_or_list, direction)
+        self._ordering = helpers._index_document(keys)
+        return self
+
+    def hint(self, index):
+        self._hint = index and helpers._index_document(index)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def _plain(self):
+        "Decoding pymongo cursor with the same options"
+        cursor = self._collection.find(self._spec, self._fields,
+                                       skip=self._skip, limit=self._limit)
+        if self._ordering:
+            cursor.sort(self._ordering.items())
+        if self._hint:
+            cursor.hint(self._hint.items())
+        return cursor
+
+    def count(self, with_limit_and_skip=False):
+        return self._plain().count(with_limit_and_skip)
+
+    def explain(self):
+        return self._plain().explain()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._killed:
+            raise StopIteration
+        name = self._collection.full_name
+        if self._id is None: # batch size of first reply is left to server
+            spec = SON({'$query': self._spec})
+            if self._ordering:
+                spec['$orderby'] = self._ordering
+            if self._hint:
+                spec['$hint'] = self._hint
+            connection = self._collection.database.connection
+            options = 4 if connection.slave_okay else 0 # slave_okay flag
+            data = self._send(message.query(options, name, self._skip,
+                                            self._limit, spec, self._fields))
+        else:
+            num = self._limit - self._retrieved if self._limit else 0
+            if self._batch_size:
+                num = min(num, self._batch_size) if num else self._batch_size
+            data = self._send(message.get_more(name, num, self._id))
+        if not self._id or (self._limit and self._retrieved >= self._limit):
+            self.close()
+        if not data and self._killed:
+            raise StopIteration
+        return data
+
+    def _send(self, msg):
+        "Send message, check reply and return its documents"
+        connection = self._collection.database.connection
+        kwargs = {'_must_use_master': False}
+        if self._connection_id is not None:
+            kwargs['_connection_to_use'] = self._connection_id
+        response = connection._send_message_with_response(msg, **kwargs)
+        if isinstance(response, tuple):
+            self._connection_id, response = response
+        flags, cursor_id, start, returned = _reply.unpack_from(response)
+        if flags & 1:
+            raise OperationFailure("cursor id '%s' not valid at server" %
+                                   self._id)
+        if flags & 2:
+            error = BSON(response[20:]).decode()['$err']
+            if error == 'not master':
+                connection.disconnect()
+                raise AutoReconnect('master has changed')
+            raise OperationFailure('database error: %s' % error)
+        self._id = cursor_id
+        self._retrieved += returned
+        return response[20:]
+
+    def close(self):
+        if self._id and not self._killed:
+            connection = self._collection.database.connection
+            if self._connection_id is not None:
+                connection.close_cursor(self._id, self._connection_id)
+            else:
+                connection.close_cursor(self._id)
+        self._killed = True
+
+    def __del__(self):
+        self.close()
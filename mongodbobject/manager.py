@@ -1,14 +1,41 @@
-import pymongo
+from bson import BSON
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+from pymongo.collection import Collection
+from aggregation import run_pipeline
 from doclist import DocList
-from models import MongoModels
-from query import Query, parse_update, parse_query
+from errors import DatabaseError, BulkWriteError
+from fields import Field
+from indexes import diff_indexes
+from instrument import one
+from lazy import RawBatchCursor
+from models import MongoModels, to_mongo
+from query import Query, PreparedQuery, parse_update, parse_query
+from routing import Router
+from session import Session, current
 
 class Manager(object):
     """Represents all methods a collection can have. To create a new
     document in a collection, call new().
     """
-    def __init__(self, connection, model_or_class):
-        "Store db connection and model or model class"
+    identity_map = None
+    result_cache = None
+    instrumentation = None
+    advisor = None
+    write_behind = None
+
+    # Upper bound of batch size in bytes for save_many()
+    max_batch_bytes = 8 * 1024 * 1024
+
+    def __init__(self, connection, model_or_class, identity_map=None,
+                 result_cache=None, instrumentation=None, advisor=None,
+                 write_behind=None):
+        """Store db connection and model or model class.
+        Pass IdentityMap to cache documents loaded by _id,
+        ResultCache to cache results of queries, Instrumentation
+        to measure operations, IndexAdvisor to check queries for indexes,
+        WriteBehind to queue writes and return at once.
+        """
 
         if isinstance(model_or_class, type):
             self.model_class = model_or_class
@@ -18,6 +45,11 @@ class Manager(object):
             self.model = model_or_class
 
         self._db = connection
+        self.identity_map = identity_map
+        self.result_cache = result_cache
+        self.instrumentation = instrumentation
+        self.advisor = advisor
+        self.write_behind = write_behind
 
     @property
     def collection(self):
@@ -28,15 +60,87 @@ class Manager(object):
     def _remove(self, query_dict):
         "Get dict and remove elements in collection"
 
-        self.collection.remove(query_dict)
+        session = current(self)
+        if session is not None:
+            return session.remove(self, query_dict)
+        if self.write_behind is not None:
+            return self.write_behind.remove(self, query_dict)
+        self._measure('remove', query_dict,
+                      lambda: self.collection.remove(query_dict))
+        self._invalidate()
     
     def _update(self, query_dict, update_dict):
         "Get dicts and update elements in collection"
 
-        self.collection.update(query_dict, update_dict)
+        session = current(self)
+        if session is not None:
+            return session.update(self, query_dict, update_dict)
+        if self.write_behind is not None:
+            return self.write_behind.update(self, query_dict, update_dict)
+        self._measure('update', query_dict,
+                      lambda: self.collection.update(query_dict, update_dict),
+                      written=[update_dict])
+        self._invalidate()
+
+    def _measure(self, name, spec, call, written=None, returned=None,
+                 explain=False):
+        "Run call() as operation of Instrumentation if any"
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return call()
+        if explain:
+            explain = lambda: self.collection.find(spec).explain()
+        else:
+            explain = None
+        return instrumentation.measure(self.model_class._name, name, spec,
+                                       call, written, returned, explain)
+
+    def _invalidate(self, _id=None):
+        "Drop cached documents of collection"
+        if self.identity_map is not None:
+            self.identity_map.invalidate(self.model_class._name, _id)
+        if self.result_cache is not None:
+            self.result_cache.bump(self.model_class._name)
+
+    def _find(self, query_dict, fields=None, route=None):
+        """Open cursor, route is kind of pools of Router to read from,
+        it is ignored for plain databases"""
+        collection = self.collection
+        if route is not None and isinstance(self._db, Router):
+            collection = self._db.route(route)[self.model_class._name]
+        return collection.find(query_dict, fields)
 
-    def _find(self, query_dict):
-        return self.collection.find(query_dict)
+    def _find_raw(self, query_dict, fields=None):
+        """Open cursor returning batches of raw BSON documents, None if
+        collection is neither pymongo Collection nor has find_raw_batches()"""
+        collection = self.collection
+        if callable(getattr(type(collection), 'find_raw_batches', None)):
+            return collection.find_raw_batches(query_dict, fields)
+        if isinstance(collection, Collection):
+            return RawBatchCursor(collection, query_dict, fields)
+        return None
+
+    def _aggregate(self, pipeline):
+        "Run aggregation pipeline, return list of result docs"
+        return self._measure('aggregate', pipeline,
+                             lambda: run_pipeline(self.collection, self._db,
+                                                  pipeline),
+                             returned=list)
+
+    def _count(self, query_dict):
+        "Count documents matching query"
+        if self.advisor is not None:
+            self.advisor.record(self, query_dict)
+        return self._measure('count', query_dict,
+                             lambda: self._find(query_dict).count(),
+                             explain=True)
+
+    def _find_fields(self, _id, fields):
+        "Load fields of one document, used for deferred fields"
+        spec = {'_id': _id}
+        return self._measure('find_fields', spec,
+                             lambda: self.collection.find_one(spec, fields),
+                             returned=one)
 
     def query(self, **kwargs):
         """This method is used to first say which documents should be
@@ -57,41 +161,323 @@ class Manager(object):
 
         return Query(self, {}, **kwargs)
 
+    def prepare(self, **template):
+        """Compile query once for repeated use with different values.
+
+        by_email = manager.prepare(email=None, active=True)
+        by_email.find_one(email='jack@example.com')
+        """
+        return PreparedQuery(self, template)
+
+    def where(self, *expressions):
+        """Find documents matching all expressions built from fields.
+        Expressions are compiled once and can be shared.
+
+        young = User.age < 30
+        manager.where(young, (User.name == 'x') | (User.name == 'y'))
+        """
+        return Query(self, {}).where(*expressions)
+
+    def aggregate(self):
+        "Start aggregation pipeline over whole collection, see Query.aggregate()"
+        return Query(self, {}).aggregate()
+
     def find_one(self, **kwargs):
         """Find one single document. Mainly this is used to retrieve
         documents by unique key.
         """
 
         if '_id' in kwargs:
-            args = pymongo.objectid.ObjectId(str(kwargs['_id']))
+            args = ObjectId(str(kwargs['_id']))
+            if self.identity_map is not None:
+                model = self.identity_map.get(self.model_class._name, args)
+                if model is not None:
+                    return model
         else:
             args = parse_query(kwargs)
 
-        doc = self.collection.find_one(args)
+        return self._find_one(args)
+
+    def _find_one(self, spec):
+        "Load one document by spec"
+        query = spec if isinstance(spec, dict) else {'_id': spec}
+        if self.advisor is not None:
+            self.advisor.record(self, query)
+        doc = self._measure('find_one', query,
+                            lambda: self.collection.find_one(spec),
+                            returned=one, explain=True)
 
         if doc is None:
             return None
 
-        return self.model_class(doc)
+        model = self.model_class._from_mongo(doc)
+        if self.identity_map is not None:
+            self.identity_map.put(self.model_class._name, model._id, model)
+        return model
 
     def save(self, model):
         """Save document to collection. 
         If document is new, set generated ID to document _id.
+        Changes of loaded document are sent as $set/$unset update.
         """
+        session = current(self)
+        if session is not None:
+            return session.save(self, model)
+        if self.write_behind is not None:
+            return self.write_behind.save(self, model)
         model.pre_save()
-        model._id = self._db[self.model_class._name].save(model)
+        update = model._get_update()
+        collection = self._db[self.model_class._name]
+        if update is None:
+            model._load_deferred() # never overwrite doc with partial one
+            doc = to_mongo(model)
+            model._id = self._measure('save', {'_id': doc.get('_id')},
+                                      lambda: collection.save(doc),
+                                      written=[doc])
+        elif update:
+            spec = {'_id': model._id}
+            self._measure('update', spec,
+                          lambda: collection.update(spec, update),
+                          written=[update])
+        self._saved(model)
+        self._invalidate(model._id)
         model.post_save()
         return model._id
         
+    def _saved(self, model):
+        "Mark model as stored in db"
+        model._reset_changes()
+        object.__setattr__(model, '_persisted', True)
+
+    def save_many(self, models, batch_size=1000, ordered=True):
+        """Save many documents. New documents are inserted in batches
+        bounded by batch_size and max_batch_bytes, one round trip per
+        batch; loaded documents are saved one by one with save().
+        Generated ids are set to documents before sending.
+
+        If ordered, first failed batch stops the load, else all batches
+        are tried. Failures are raised as BulkWriteError at the end.
+        """
+        errors = []
+        batch, batch_bytes = [], 0
+        batches = []
+        for model in models:
+            if model._persisted:
+                self.save(model)
+                continue
+
+            model.pre_save()
+            if '_id' not in model:
+                model._id = ObjectId()
+            doc = to_mongo(model)
+            size = len(BSON.encode(doc))
+            if batch and (len(batch) >= batch_size or
+                          batch_bytes + size > self.max_batch_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append((model, doc))
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+
+        for number, batch in enumerate(batches):
+            docs = [doc for model, doc in batch]
+            try:
+                self._measure('insert', None,
+                              lambda: self.collection.insert(docs, safe=True),
+                              written=docs)
+            except OperationFailure, e:
+                errors.append((number, [model for model, doc in batch], e))
+                if ordered:
+                    break
+                continue
+
+            for model, doc in batch:
+                self._saved(model)
+                model.post_save()
+
+        if batches and self.result_cache is not None:
+            self.result_cache.bump(self.model_class._name)
+
+        if errors:
+            raise BulkWriteError(errors)
+
+    def upsert_many(self, models, key, batch_size=1000, ordered=True):
+        """Insert or update documents matched by key field or list of fields.
+        Every batch costs one query for existing keys, one insert of new
+        documents and one update per existing document, all acknowledged.
+        Documents with the same key are written to one document. Without
+        unique index on key, documents inserted by others meanwhile get
+        duplicated.
+
+        If ordered, first failure stops the load, else all documents are
+        tried. Failures are raised as BulkWriteError at the end: failed
+        insert with all new documents of its batch, failed update with its
+        document.
+        """
+        if isinstance(key, (Field, basestring)):
+            key = [key]
+        key = [k.name if isinstance(k, Field) else k.replace('__', '.')
+               for k in key]
+
+        def lookup(doc, path):
+            for part in path.split('.'):
+                doc = doc.get(part) if isinstance(doc, dict) else None
+            return doc
+
+        def spec(doc):
+            return dict((k, lookup(doc, k)) for k in key)
+
+        errors = []
+        models = list(models)
+        for number, start in enumerate(xrange(0, len(models), batch_size)):
+            batch = models[start:start + batch_size]
+            docs = []
+            for model in batch:
+                model.pre_save()
+                docs.append(to_mongo(model))
+            specs = [spec(doc) for doc in docs]
+
+            if len(key) == 1:
+                query = {key[0]: {'$in': [s[key[0]] for s in specs]}}
+            else:
+                query = {'$or': specs}
+            ids = {}
+            found = self._measure('find', query, lambda: list(
+                self.collection.find(query, key)), returned=list)
+            for doc in found:
+                ids[tuple(lookup(doc, k) for k in key)] = doc['_id']
+
+            inserts, updates = [], []
+            for model, doc, s in zip(batch, docs, specs):
+                k = tuple(s[name] for name in key)
+                _id = ids.get(k)
+                if _id is None:
+                    _id = ids[k] = dict.get(doc, '_id') or ObjectId()
+                    inserts.append((model, dict(doc, _id=_id)))
+                else:
+                    updates.append((model, _id, dict(
+                        (f, v) for f, v in dict.iteritems(doc) if f != '_id')))
+
+            stored = []
+            if inserts:
+                new = [doc for model, doc in inserts]
+                try:
+                    self._measure('insert', None,
+                                  lambda: self.collection.insert(new, safe=True),
+                                  written=new)
+                except OperationFailure, e:
+                    # updates of documents of the batch are lost with them
+                    failed = set(doc['_id'] for doc in new)
+                    errors.append((number, [model for model, doc in inserts] +
+                                   [model for model, _id, update in updates
+                                    if _id in failed], e))
+                    if ordered:
+                        break
+                    updates = [u for u in updates if u[1] not in failed]
+                else:
+                    stored.extend((model, doc['_id']) for model, doc in inserts)
+
+            for model, _id, update in updates:
+                by_id = {'_id': _id}
+                try:
+                    self._measure('update', by_id,
+                                  lambda: self.collection.update(
+                                      by_id, {'$set': update}, upsert=True,
+                                      safe=True),
+                                  written=[update])
+                except OperationFailure, e:
+                    errors.append((number, [model], e))
+                    if ordered:
+                        break
+                    continue
+                stored.append((model, _id))
+
+            for model, _id in stored:
+                dict.__setitem__(model, '_id', _id)
+                self._saved(model)
+                model.post_save()
+            if errors and ordered:
+                break
+
+        self._invalidate()
+        if errors:
+            raise BulkWriteError(errors)
+
     def delete(self, model):
         "Remove document from collection if document id exists."
+        session = current(self)
+        if session is not None:
+            return session.delete(self, model)
+        if self.write_behind is not None:
+            return self.write_behind.delete(self, model)
         model.pre_delete()
         if '_id' in model:
-            self._db[self.model_class._name].remove({'_id': model._id})
+            spec = {'_id': model._id}
+            self._measure('remove', spec,
+                          lambda: self._db[self.model_class._name].remove(spec))
+            self._invalidate(model._id)
             del model['_id']
+            object.__setattr__(model, '_persisted', False)
+
+    def session(self, *managers):
+        """Unit of work buffering writes of this manager and given managers
+        until the block exits, see Session. Opening a session of a manager
+        with an open session in this thread returns the open one.
+
+        with users.session() as session:
+            ...
+        """
+        session = current(self)
+        if session is not None:
+            return session
+        return Session((self,) + managers)
+
+    def index_diff(self):
+        """Compare declared indexes of model with indexes on server.
+        Return (missing indexes, (index, existing name) of conflicts)."""
+        return diff_indexes(self.model_class._indexes,
+                            self.collection.index_information())
+
+    def ensure_indexes(self, background=False, replace=False):
+        """Build declared indexes missing on server, in background if asked.
+        Existing index with the same keys but other options raises
+        DatabaseError, with replace it is dropped and built again.
+        Return names of built indexes.
+        """
+        missing, conflicts = self.index_diff()
+        if conflicts and not replace:
+            raise DatabaseError('Indexes of %s differ from declared: %s' % (
+                self.model_class._name,
+                ', '.join(name for index, name in conflicts)))
+
+        for index, name in conflicts:
+            self.collection.drop_index(name)
+            missing.append(index)
+
+        for index in missing:
+            options = index.options()
+            if background:
+                options['background'] = True
+            self.collection.create_index(index.spec, name=index.name,
+                                         **options)
+        return [index.name for index in missing]
 
     def dereference(self, dbref):
-        return MongoModels.dereference(self._db, dbref) 
+        return self._measure('dereference', {'_id': dbref.id},
+                             lambda: MongoModels.dereference(
+                                 self._db, dbref, self.identity_map),
+                             returned=one)
+
+    def dereference_many(self, dbrefs):
+        """Dereference list of DBRefs with one query per collection.
+        Return list of models in the same order, None for missing docs.
+        """
+        resolved = self._measure('dereference', None,
+                                 lambda: MongoModels.dereference_many(
+                                     self._db, dbrefs, self.identity_map),
+                                 returned=lambda r: r.values())
+        return [resolved.get((r.collection, r.id)) for r in dbrefs]
 
     # Aliases        
     def add(self, model):
@@ -1,6 +1,16 @@
+import datetime
+
+from bson import BSON
+from bson.objectid import ObjectId
 from pymongo.dbref import DBRef
-from errors import DatabaseError
+from errors import DatabaseError, ValidationError
 from fields import Field
+from indexes import Index
+from lazy import RawValue
+
+# Types of values which never contain models
+SCALARS = frozenset([type(None), bool, int, long, float, str, unicode,
+                     ObjectId, datetime.datetime])
 
 
 class MongoModels(object):
@@ -14,8 +24,93 @@ class MongoModels(object):
         cls.models[model._name] = model
 
     @classmethod
-    def dereference(cls, db, dbref):
-        return cls.models[dbref.collection](db.dereference(dbref))
+    def dereference(cls, db, dbref, identity_map=None):
+        if identity_map is not None:
+            model = identity_map.get(dbref.collection, dbref.id)
+            if model is not None:
+                return model
+
+        doc = db.dereference(dbref)
+        if doc is None:
+            return None
+        model = cls.models[dbref.collection]._from_mongo(doc)
+        if identity_map is not None:
+            identity_map.put(dbref.collection, dbref.id, model)
+        return model
+
+    @classmethod
+    def dereference_many(cls, db, dbrefs, identity_map=None):
+        """Resolve many DBRefs issuing one $in query per collection.
+        Return dict {(collection, id): model}, missing documents are skipped."""
+        resolved = {}
+        ids = {}
+        for dbref in dbrefs:
+            if identity_map is not None:
+                model = identity_map.get(dbref.collection, dbref.id)
+                if model is not None:
+                    resolved[(dbref.collection, dbref.id)] = model
+                    continue
+            ids.setdefault(dbref.collection, set()).add(dbref.id)
+
+        for collection, id_set in ids.iteritems():
+            model_class = cls.models[collection]
+            for doc in db[collection].find({'_id': {'$in': list(id_set)}}):
+                model = model_class._from_mongo(doc)
+                resolved[(collection, doc['_id'])] = model
+                if identity_map is not None:
+                    identity_map.put(collection, doc['_id'], model)
+        return resolved
+
+    @classmethod
+    def prefetch(cls, db, docs, paths, identity_map=None):
+        """Replace DBRefs found by paths in docs with resolved models.
+        Path use django style notation: 'friends', 'author__profile'.
+        Every path level costs one query per referenced collection."""
+        for path in paths:
+            targets = list(docs)
+            for key in path.split('__'):
+                refs = []
+                for target in targets:
+                    value = target.get(key)
+                    if isinstance(value, list):
+                        refs.extend(v for v in value if isinstance(v, DBRef))
+                    elif isinstance(value, DBRef):
+                        refs.append(value)
+
+                resolved = {}
+                if refs:
+                    resolved = cls.dereference_many(db, refs, identity_map)
+
+                def wire(value):
+                    if isinstance(value, DBRef):
+                        return resolved.get((value.collection, value.id), value)
+                    return value
+
+                next_targets = []
+                for target in targets:
+                    value = target.get(key)
+                    # Replace without conversion to DBRef and recording changes
+                    if isinstance(value, list):
+                        for i, v in enumerate(value):
+                            list.__setitem__(value, i, wire(v))
+                        next_targets.extend(v for v in value if isinstance(v, dict))
+                    elif isinstance(value, DBRef):
+                        value = wire(value)
+                        dict.__setitem__(target, key, value)
+                        if isinstance(value, dict):
+                            next_targets.append(value)
+                    elif isinstance(value, dict):
+                        next_targets.append(value)
+                targets = next_targets
+
+    @classmethod
+    def ensure_indexes(cls, db, background=False, replace=False):
+        """Build missing indexes of all registered models, see
+        Manager.ensure_indexes(). Return {model name: built index names}."""
+        from manager import Manager
+        return dict((name, Manager(db, model).ensure_indexes(background,
+                                                             replace))
+                    for name, model in cls.models.iteritems())
 
 
 class AutoDBRef(DBRef):
@@ -27,43 +122,403 @@ class AutoDBRef(DBRef):
         return self._manager.dereference(self)
 
 
+def _dbref(value):
+    "Replace nested models with DBRefs, return value itself if none found"
+    if isinstance(value, Model):
+        return DBRef(value._name, value._id, value._database_name)
+
+    if isinstance(value, list):
+        items = [_dbref(v) for v in list.__iter__(value)]
+        if any(a is not b for a, b in zip(items, value)):
+            return items
+
+    elif isinstance(value, dict):
+        return to_mongo(value)
+
+    return value
+
+
+def to_mongo(doc):
+    """Prepare document for saving: models wired into it by prefetch
+    are replaced with DBRefs. Return doc itself if nothing to replace."""
+    if isinstance(doc, Model):
+        return doc._encode(doc)
+    items = dict((k, _dbref(v)) for k, v in dict.iteritems(doc))
+    if any(items[k] is not v for k, v in dict.iteritems(doc)):
+        return items
+    return doc
+
+
+def _snapshot(doc):
+    "Copy of document or update to write later, sharing nothing with it"
+    return BSON(BSON.encode(doc)).decode()
+
+
+def _track(container, root, path, whole):
+    "Attach container to root which collects its changes"
+    object.__setattr__(container, '_root', root)
+    object.__setattr__(container, '_path', path)
+    object.__setattr__(container, '_whole', whole)
+    return container
+
+
+def _adopt(value):
+    """Prepare value for storing in HandyDict or HandyList: models
+    become DBRefs, containers of other documents are copied."""
+    if isinstance(value, Model):
+        return DBRef(value._name, value._id, value._database_name)
+    if isinstance(value, HandyDict):
+        return dict(value)
+    if isinstance(value, HandyList):
+        return list(list.__iter__(value))
+    return value
+
+
+def _plain(value):
+    "Copy tracked containers in value to plain dicts and lists"
+    if type(value) is HandyDict:
+        return dict((k, _plain(v)) for k, v in dict.iteritems(value))
+    if type(value) is HandyList:
+        return [_plain(v) for v in list.__iter__(value)]
+    return value
+
+
+def _restore(cls, doc, changes, state):
+    "Rebuild HandyDict or model copied or unpickled by __reduce_ex__()"
+    obj = dict.__new__(cls)
+    dict.update(obj, doc)
+    _track(obj, None, '', False)
+    object.__setattr__(obj, '_changes', changes)
+    for k, v in state.iteritems():
+        object.__setattr__(obj, k, v)
+    return obj
+
+
+def _tracked(name):
+    "Wrap list method to report modification"
+    method = getattr(list, name)
+    def wrapper(self, *args):
+        result = method(self, *args)
+        if self._root is not None:
+            self._root._record(self._path, True)
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+
+class HandyList(list):
+    """List which reports any modification to root HandyDict
+    as change of the whole list. Nested dicts and lists are
+    converted on first access."""
+    __slots__ = ('_root', '_path', '_whole')
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        _track(self, None, None, True)
+
+    def _load(self):
+        "Adopt stored items without recording changes"
+        for i, v in enumerate(list.__iter__(self)):
+            if isinstance(v, (HandyDict, HandyList)):
+                list.__setitem__(self, i, _adopt(v))
+        return self
+
+    def _wrap(self, i, v):
+        "Convert nested dict or list, changes inside it change the list"
+        if type(v) is list:
+            w = _track(HandyList(v), self._root, self._path, True)._load()
+        else:
+            w = _track(HandyDict.__new__(HandyDict), self._root, self._path, True)
+            object.__setattr__(w, '_changes', None)
+            dict.update(w, v)
+            w._load()
+        list.__setitem__(self, i, w)
+        return w
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        v = list.__getitem__(self, i)
+        if type(v) is dict or type(v) is list:
+            return self._wrap(i, v)
+        return v
+
+    def __getslice__(self, i, j):
+        return self[slice(i, j)]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __reduce_ex__(self, protocol):
+        "Copy and pickle as list not attached to any document"
+        return (HandyList, (_plain(self),))
+
+    append = _tracked('append')
+    extend = _tracked('extend')
+    insert = _tracked('insert')
+    remove = _tracked('remove')
+    pop = _tracked('pop')
+    sort = _tracked('sort')
+    reverse = _tracked('reverse')
+    __setitem__ = _tracked('__setitem__')
+    __delitem__ = _tracked('__delitem__')
+    __setslice__ = _tracked('__setslice__')
+    __delslice__ = _tracked('__delslice__')
+    __iadd__ = _tracked('__iadd__')
+    __imul__ = _tracked('__imul__')
+
+
 class HandyDict(dict):
-    "Smart dict with handy access to dict elements"
+    """Smart dict with handy access to dict elements.
+    Nested dicts and lists are converted to HandyDict and HandyList
+    on first access, so untouched parts of document cost nothing.
+    Top level HandyDict records changed paths of itself and nested
+    containers: {'path': True} for set, {'path': False} for unset.
+    """
+    __slots__ = (
+        '_root', # HandyDict collecting changes, None for top level
+        '_path', # dotted path from root
+        '_whole', # report changes as change of _path (dicts in lists)
+        '_changes', # collected changes, None while not tracking
+    )
 
     def __init__(self, *args, **kwargs):
-        """Init dict, then convert included dicts to BaseDoc.
-        All dicts in lists and tuples are converted too."""
+        """Init dict, included dicts and lists are converted lazily."""
 
         dict.__init__(self, *args, **kwargs)
+        _track(self, None, '', False)
+        object.__setattr__(self, '_changes', None)
+        self._load()
+        object.__setattr__(self, '_changes', {})
+
+    def _load(self):
+        "Adopt stored values without recording changes"
+        for k, v in dict.iteritems(self):
+            if isinstance(v, (HandyDict, HandyList)):
+                dict.__setitem__(self, k, _adopt(v))
+        return self
+
+    def _wrap(self, k, v):
+        "Convert nested dict or list and cache it"
+        root = self._root if self._root is not None else self
+        if self._whole:
+            path = self._path
+        else:
+            path = self._path + '.' + k if self._path else k
+
+        if type(v) is list:
+            w = _track(HandyList(v), root, path, True)._load()
+        else:
+            w = _track(HandyDict.__new__(HandyDict), root, path, self._whole)
+            object.__setattr__(w, '_changes', None)
+            dict.update(w, v)
+            w._load()
+        dict.__setitem__(self, k, w)
+        return w
+
+    def _mark(self, k, is_set):
+        "Report change of key k to root"
+        root = self._root if self._root is not None else self
+        if self._whole:
+            root._record(self._path, True)
+        else:
+            root._record(self._path + '.' + k if self._path else k, is_set)
+
+    def _record(self, path, is_set):
+        "Store change, drop changes of nested paths"
+        if self._changes is None:
+            return
+        prefix = path + '.'
+        for p in [p for p in self._changes if p.startswith(prefix)]:
+            del self._changes[p]
+        self._changes[path] = is_set
+
+    def _reset_changes(self):
+        "Forget collected changes, e.g. after save"
+        object.__setattr__(self, '_changes', {})
 
-        for a, b in self.items():
-            self._update(a, b)
+    def _update(self, k, v):
+        "Set value and record change"
+        dict.__setitem__(self, k, _adopt(v))
+        self._mark(k, True)
 
-    def _convert(self, v):
-        "Convert value"
-        if isinstance(v, list):
-            return [self._convert(x) for x in v]
+    def _load_deferred(self):
+        "Load fields skipped by projection, return False if nothing loaded"
+        if self._root is not None:
+            return self._root._load_deferred()
+        return False
 
-        if isinstance(v, Model):
-            return DBRef(v._name, v._id, v._database_name)
+    def __getitem__(self, k):
+        try:
+            v = dict.__getitem__(self, k)
+        except KeyError:
+            if not self._load_deferred():
+                raise
+            v = dict.__getitem__(self, k)
+        if type(v) is RawValue:
+            v = self._decode(k, v)
+        if type(v) is dict or type(v) is list:
+            return self._wrap(k, v)
+        return v
 
-        elif isinstance(v, dict):
-            return HandyDict(v)
+    def __setitem__(self, k, v):
+        self._update(k, v)
 
-        return v
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self._mark(k, False)
 
-    def _update(self, k, v):
-        "Convert all dicts in v to HandyDict"
-        dict.__setitem__(self, k, self._convert(v))
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for k in dict.iterkeys(self):
+            yield k, self[k]
+
+    def itervalues(self):
+        for k in dict.iterkeys(self):
+            yield self[k]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self._update(k, v)
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self._update(k, default)
+        return self[k]
+
+    def pop(self, k, *default):
+        if k in self:
+            v = self[k]
+            self.__delitem__(k)
+            return v
+        return dict.pop(self, k, *default)
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._mark(k, False)
+        return k, v
+
+    def clear(self):
+        for k in self.keys():
+            self._mark(k, False)
+        dict.clear(self)
 
     def __setattr__(self, k, v):
         self._update(k, v)
 
     def __delattr__(self, k):
-        dict.__delitem__(self, k)
+        self.__delitem__(k)
 
     def __getattr__(self, k):
-        return dict.__getitem__(self, k)
+        if k.startswith('__'):
+            raise AttributeError(k) # protocols looked up by copy and pickle
+        return self[k]
+
+    def __reduce_ex__(self, protocol):
+        """Copy and pickle keeping recorded changes. Nested containers are
+        copied detached from their document."""
+        doc = dict((k, _plain(v)) for k, v in dict.iteritems(self))
+        changes = self._changes
+        if changes is not None:
+            changes = dict(changes)
+        try:
+            state = dict(object.__getattribute__(self, '__dict__'))
+        except AttributeError: # no attributes besides slots
+            state = {}
+        return (_restore, (type(self), doc, changes, state))
+
+
+def _merge(target, doc):
+    "Fill keys missing in target from doc"
+    for k, v in doc.iteritems():
+        if not dict.__contains__(target, k):
+            dict.__setitem__(target, k, v)
+            continue
+        current = dict.__getitem__(target, k)
+        if isinstance(v, dict) and isinstance(current, dict) \
+                and not isinstance(current, Model):
+            if type(current) is dict:
+                # loaded dict could be shared, e.g. by result cache
+                current = dict(current)
+                dict.__setitem__(target, k, current)
+            _merge(current, v)
+
+
+def _default(field):
+    "Function returning default value of field, None if it has none"
+    default = field.default
+    if default is None:
+        return None
+    if isinstance(default, (list, dict)):
+        return lambda: field.type(default)
+    return lambda: default
+
+
+def _compile(fields):
+    """Build functions specialized for fields of one model.
+
+    prepare(model, changes, defaults=True) sets missing defaults, recording
+    them in changes, and coerces values of fields. Values which can not be
+    coerced are kept, documents loaded from db are not rejected. Fields
+    overriding Field.process_model() get it called with defaults.
+
+    encode(model) returns document for saving: values of fields coerced
+    and validated, models replaced with DBRefs. Raises ValidationError."""
+    steps = [(name, _default(field), field.coerce)
+             for name, field in sorted(fields.iteritems())]
+    checks = dict((name, field.coerce) for name, field in fields.iteritems())
+    custom = [field.process_model for name, field in sorted(fields.iteritems())
+              if type(field).process_model.im_func is not
+              Field.process_model.im_func]
+
+    def prepare(model, changes, defaults=True):
+        for name, default, coerce in steps:
+            value = dict.get(model, name)
+            if type(value) is RawValue:
+                continue # coerced when decoded
+            if value is not None:
+                try:
+                    coerced = coerce(value)
+                except ValidationError:
+                    continue
+                if coerced is not value:
+                    dict.__setitem__(model, name, coerced)
+            elif defaults and default is not None and \
+                    not dict.__contains__(model, name):
+                dict.__setitem__(model, name, default())
+                changes[name] = True
+        if defaults:
+            for process in custom:
+                process(model)
+
+    def encode(model):
+        doc = None
+        for k, v in dict.iteritems(model):
+            value = v.decode() if type(v) is RawValue else v
+            coerce = checks.get(k)
+            if coerce is not None:
+                value = coerce(value)
+            if type(value) not in SCALARS:
+                value = _dbref(value)
+            if value is not v:
+                if doc is None:
+                    doc = dict.copy(model)
+                doc[k] = value
+        return model if doc is None else doc
+
+    return prepare, encode
 
 
 class MetaModel(type):
@@ -84,9 +539,20 @@ class MetaModel(type):
                 fields[k] = v
                 del dict[k]
 
+        # Indexes are only collected here, Manager.ensure_indexes() builds them
+        indexes = list(dict.get('_indexes', ()))
+        declared = [index.spec for index in indexes]
+        for field in fields.values():
+            if field.order and [(field.name, field.order)] not in declared:
+                indexes.append(Index(field))
+
         model = type.__new__(mcs, name, bases, dict)
         model._name = model._prefix + '_' + name if model._prefix else name
         model._fields = fields
+        model._indexes = indexes
+        prepare, encode = _compile(fields)
+        model._prepare = staticmethod(prepare)
+        model._encode = staticmethod(encode)
 
         # Add to models collection for dereference
         if not base_model:
@@ -111,13 +577,112 @@ class Model(HandyDict):
     _prefix = '' # prepend collection name
     _base_model = True # base models are not in fact really models
     
+    _persisted = False # loaded from or saved to db
+    _deferred = None # loader of fields skipped by projection
+    
     def __init__(self, *args, **kwargs):
         """
         Ensure that all fields prepared.
         """
         super(Model, self).__init__(*args, **kwargs)
-        for field in self._fields.values():
-            field.process_model(self)
+        self._prepare(self, self._changes)
+
+    @classmethod
+    def _from_mongo(cls, doc, deferred=None):
+        """Create model from document loaded from db.
+        deferred is called to load fields skipped by projection."""
+        if cls.__init__.im_func is not Model.__init__.im_func:
+            model = cls(doc)
+            if deferred is not None:
+                # Field defaults could hide deferred values, apply them later
+                for k in model._changes:
+                    dict.__delitem__(model, k)
+                model._reset_changes()
+        else:
+            # docs from db hold no containers to adopt, skip HandyDict init
+            model = dict.__new__(cls)
+            dict.update(model, doc)
+            _track(model, None, '', False)
+            object.__setattr__(model, '_changes', {})
+            cls._prepare(model, model._changes, deferred is None)
+        object.__setattr__(model, '_persisted', True)
+        if deferred is not None:
+            object.__setattr__(model, '_deferred', deferred)
+        return model
+
+    def _decode(self, k, raw):
+        "Decode value of lazy model and coerce it like prepare() does"
+        value = raw.decode()
+        field = self._fields.get(k)
+        if field is not None:
+            try:
+                value = field.coerce(value)
+            except ValidationError:
+                pass
+        dict.__setitem__(self, k, value)
+        return value
+
+    def _decode_all(self):
+        "Decode values of lazy model still kept as BSON"
+        for k, v in dict.items(self):
+            if type(v) is RawValue:
+                self._decode(k, v)
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, Model):
+            other._decode_all()
+        return dict.__eq__(self._decode_all(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        "Return dict of values, see dict.copy()"
+        return dict.copy(self._decode_all())
+
+    def __reduce_ex__(self, protocol):
+        return HandyDict.__reduce_ex__(self._decode_all(), protocol)
+
+    def _load_deferred(self):
+        "Load fields skipped by projection, return False if nothing loaded"
+        deferred = self._deferred
+        if deferred is None:
+            return False
+        object.__setattr__(self, '_deferred', None)
+        doc = deferred()
+        if doc is not None:
+            _merge(self, doc)
+        self._prepare(self, self._changes)
+        return True
+
+    def _get_update(self):
+        """Return $set/$unset update for changes made since loading
+        or None if the whole document should be saved."""
+        if not self._persisted or '_id' in self._changes or '_id' not in self:
+            return None
+
+        update = {}
+        for path, is_set in self._changes.iteritems():
+            parts = path.split('.')
+            if any('.'.join(parts[:i]) in self._changes
+                   for i in range(1, len(parts))):
+                continue # covered by change of parent
+
+            if is_set:
+                value = self
+                try:
+                    for part in parts:
+                        value = value[part]
+                except (KeyError, TypeError):
+                    continue # stale path of detached container
+                field = self._fields.get(path)
+                if field is not None:
+                    value = field.coerce(value)
+                update.setdefault('$set', {})[path] = _dbref(value)
+            else:
+                update.setdefault('$unset', {})[path] = 1
+        return update
 
     @property
     def id(self):
@@ -0,0 +1,152 @@
+"Run functions over query results in a pool of processes"
+
+import multiprocessing
+
+import pymongo
+
+# Options of query applied in workers
+OPTIONS = ('fields', 'row', 'prefetch', 'lazy', 'hint', 'batch_size')
+
+
+class Connect(object):
+    """Picklable database factory for worker processes.
+    Every worker opens its own connection."""
+    def __init__(self, host, port, name):
+        self.host = host
+        self.port = port
+        self.name = name
+
+    @classmethod
+    def from_db(cls, db):
+        """Take connection parameters of pymongo database. Databases
+        without one connection, like Router, need their own factory."""
+        connection = getattr(db, 'connection', None)
+        if connection is None:
+            raise ValueError('no connection parameters in %r, pass connect='
+                             % db)
+        return cls(connection.host, connection.port, db.name)
+
+    def __call__(self):
+        return pymongo.Connection(self.host, self.port)[self.name]
+
+
+def split_ids(query, chunks):
+    """Return list of (low, high) _id bounds splitting query result into
+    'chunks' disjoint ranges of similar size. None means unbounded."""
+    count = query.count()
+    bounds = [None]
+    for i in range(1, chunks):
+        docs = list(query._derive(sort=[('_id', 1)], skip=i * count // chunks,
+                                  limit=1, fields={'_id': 1}, row=dict))
+        if docs and docs[0]['_id'] != bounds[-1]:
+            bounds.append(docs[0]['_id'])
+    bounds.append(None)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _options(query):
+    "Options of query for workers, ValueError if they can not be kept"
+    if query._sort or query._skip or query._limit:
+        raise ValueError('parallel_map() does not support sort, skip and '
+                         'limit, results come in _id ranges')
+    if query._row not in (None, dict):
+        raise ValueError('parallel_map() supports models and raw() only')
+    return dict((k, getattr(query, '_' + k)) for k in OPTIONS)
+
+
+def _run_chunk(job):
+    "Process one _id range in worker, retry on failure"
+    from manager import Manager
+    from query import Query
+
+    (connect, model_class, query_dict, options, (low, high), func, reduce,
+     retries) = job
+    id_range = {}
+    if low is not None:
+        id_range['$gte'] = low
+    if high is not None:
+        id_range['$lt'] = high
+    if id_range and '_id' in query_dict:
+        query_dict = {'$and': [query_dict, {'_id': id_range}]}
+    elif id_range:
+        query_dict = dict(query_dict, _id=id_range)
+
+    for attempt in range(retries + 1):
+        try:
+            query = Query(Manager(connect(), model_class), query_dict)
+            for k, v in options.iteritems():
+                setattr(query, '_' + k, v)
+
+            if reduce is None:
+                return [func(model) for model in query]
+
+            result, empty = None, True
+            for model in query:
+                value = func(model)
+                if empty:
+                    result, empty = value, False
+                else:
+                    result = reduce(result, value)
+            return empty, result
+        except Exception:
+            if attempt == retries:
+                raise
+
+
+def parallel_map(query, func, workers=None, chunks=None, reduce=None,
+                 connect=None, retries=1, progress=None):
+    """Apply func to every model of query in pool of processes.
+    Query is split into 'chunks' _id ranges (4 per worker by default),
+    each range is loaded and converted to models in a worker with its
+    own connection. func, reduce and model class must be picklable.
+
+    Without reduce yield results as chunks complete. With reduce every
+    chunk is reduced in its worker and chunk results are reduced again,
+    the final value is returned.
+
+    Failed chunk is retried 'retries' times. progress(done, total) is
+    called after every chunk.
+
+    Fields, prefetch, lazy() and raw() of query are kept, sort, skip,
+    limit and values() raise ValueError. connect is a picklable database
+    factory, e.g. Connect, it is required for managers of Router.
+    """
+    options = _options(query)
+    workers = workers or multiprocessing.cpu_count()
+    chunks = chunks or workers * 4
+    connect = connect or Connect.from_db(query._manager._db)
+
+    ranges = split_ids(query, chunks)
+    jobs = [(connect, query._manager.model_class, query._query, options,
+             r, func, reduce, retries) for r in ranges]
+
+    pool = multiprocessing.Pool(workers)
+    results = pool.imap_unordered(_run_chunk, jobs)
+    if reduce is None:
+        return _stream(pool, results, len(jobs), progress)
+
+    try:
+        value, empty = None, True
+        for done, (chunk_empty, chunk_value) in enumerate(results):
+            if not chunk_empty:
+                value = chunk_value if empty else reduce(value, chunk_value)
+                empty = False
+            if progress is not None:
+                progress(done + 1, len(jobs))
+        return value
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _stream(pool, results, total, progress):
+    "Yield results of chunks, close pool when done"
+    try:
+        for done, chunk in enumerate(results):
+            for value in chunk:
+                yield value
+            if progress is not None:
+                progress(done + 1, total)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,7 +1,105 @@
 "Define Query class"
 
-import pymongo
+import base64
+from itertools import islice
+
+from bson import BSON
+from bson.objectid import ObjectId
+from aggregation import Aggregation
 from doclist import DocList
+from fields import Field, And
+from parallel import parallel_map
+
+QUERY_OPERATORS = ('lte', 'gte', 'lt', 'gt', 'ne', 'in', 'nin', 'all', 'size')
+
+UPDATE_OPERATORS = {'inc': '$inc', 'set': '$set', 'push': '$push',
+                    'pushall': '$pushAll', 'pull': '$pull',
+                    'pullall': '$pullAll'}
+
+# Upper bound of cached plans, cache is dropped when exceeded
+MAX_PLANS = 1000
+
+
+def to_oid(v):
+    if isinstance(v, list):
+        return [ObjectId(i) for i in v]
+    else:
+        return ObjectId(v)
+
+
+class QueryPlan(object):
+    """parse_query() compiled for one set of keywords.
+    Splitting of keywords is done once, bind() only places values."""
+    def __init__(self, keys):
+        self.keys = frozenset(keys)
+        self.steps = []
+        for k in keys:
+            parts = k.split('__')
+            op = None
+            if len(parts) > 1 and parts[-1] in QUERY_OPERATORS:
+                op = '$' + parts.pop()
+            # convert django style notation into dot notation
+            key = '.'.join(parts)
+            self.steps.append((k, key, op, key == '_id'))
+
+    def bind(self, kwargs):
+        "Build query dict from values"
+        q = {}
+        for k, key, op, is_id in self.steps:
+            v = kwargs[k]
+            if is_id:
+                v = to_oid(v)
+            if op is None:
+                q[key] = v
+                continue
+            # group operators of one key: age__gt, age__lt
+            cond = q.get(key)
+            if not isinstance(cond, dict):
+                cond = q[key] = {}
+            cond[op] = v
+        return q
+
+
+class UpdatePlan(object):
+    "parse_update() compiled for one set of keywords"
+    def __init__(self, keys):
+        self.keys = frozenset(keys)
+        self.steps = []
+        for k in keys:
+            op, _, key = k.partition('__')
+            if key and op in UPDATE_OPERATORS:
+                self.steps.append((k, UPDATE_OPERATORS[op],
+                                   key.replace('__', '.')))
+            else:
+                # simple value assignment
+                self.steps.append((k, None, k))
+
+    def bind(self, kwargs):
+        "Build update dict from values"
+        q = {}
+        for k, op, key in self.steps:
+            if op is None:
+                q[key] = kwargs[k]
+            else:
+                q.setdefault(op, {})[key] = kwargs[k]
+        return q
+
+
+_query_plans = {}
+_update_plans = {}
+
+
+def _plan(cache, plan_class, kwargs):
+    "Return cached plan for keywords signature"
+    signature = frozenset(kwargs)
+    try:
+        return cache[signature]
+    except KeyError:
+        if len(cache) >= MAX_PLANS:
+            cache.clear()
+        plan = cache[signature] = plan_class(signature)
+        return plan
+
 
 def parse_query(kwargs):
     """Parse argument list into mongo query.
@@ -11,34 +109,9 @@ def parse_query(kwargs):
         (comment__user='john') => {'comment.user': 'john'}
         (comment__rating__lt=10) => {'comment.rating': {'$lt': 10}}
         (user__in=[10, 20]) => {'user': {'$in': [10, 20]}}
+        (age__gt=10, age__lt=20) => {'age': {'$gt': 10, '$lt': 20}}
     """
-    def to_oid(v):
-        if isinstance(v, list):
-            return [pymongo.objectid.ObjectId(i) for i in v]
-        else:
-            return pymongo.objectid.ObjectId(v)
-
-    q = {}
-    # iterate over kwargs and build query dict
-    for k, v in kwargs.items():
-        if v == None:
-            print 'Warning: None value for %s key.' % k
-        # handle query operators
-        op = k.split('__')[-1]
-        if op in ('lte', 'gte', 'lt', 'gt', 'ne', 'in', 'nin', 'all', 'size'):
-            k = k.rstrip('__' + op)
-            if k == '_id':
-                v = to_oid(v)
-
-            v = {'$' + op: v}
-
-        elif k == '_id':
-            v = to_oid(v)
-
-        # convert django style notation into dot notation
-        key = k.replace('__', '.')
-        q[key] = v
-    return q
+    return _plan(_query_plans, QueryPlan, kwargs).bind(kwargs)
 
 
 def parse_update(kwargs):
@@ -46,61 +119,262 @@ def parse_update(kwargs):
 
     Examples:
         (name='jack')  =>  {'name': 'jack'}
-        (person__gender='male')  =>  {'person.gender': 'male'}
         (set__friends=['mike'])  =>  {'$set': {'friends': ['mike']}}
         (push__friends='john')  =>  {'$push': {'friends': 'john'}}
+        (set__person__gender='male', set__name='john')  =>
+            {'$set': {'person.gender': 'male', 'name': 'john'}}
     """
-    q = {}
-    op_list = {}
-    # iterate over kwargs
-    for k, v in kwargs.items():
-
-        # get modification operator
-        op = k.split('__')[0]
-        if op in ('inc', 'set', 'push', 'pushall', 'pull', 'pullall'):
-            # pay attention to case sensitivity
-            op = op.replace('pushall', 'pushAll')
-            op = op.replace('pullall', 'pullAll')
-
-            # remove operator from key
-            k = k.replace(op + '__', '')
-
-            # append values to operator list (group operators)
-            if not op_list.has_key(op):
-                op_list[op] = []
-
-            op_list[op].append((k, v))
-        # simple value assignment
+    return _plan(_update_plans, UpdatePlan, kwargs).bind(kwargs)
+
+
+class PreparedQuery(object):
+    """Query compiled once and reused with different values.
+    Keywords of template are fixed, values given to find() and
+    find_one() replace template values.
+
+        active = manager.prepare(status='active', age__gt=0)
+        active.find(age__gt=30)
+    """
+    def __init__(self, manager, template):
+        self._manager = manager
+        self._template = template
+        self._plan = QueryPlan(template)
+
+    def bind(self, **values):
+        "Return query dict for values"
+        if not self._plan.keys.issuperset(values):
+            unknown = set(values) - self._plan.keys
+            raise TypeError('Not prepared keywords: %s' % ', '.join(unknown))
+        kwargs = self._template.copy()
+        kwargs.update(values)
+        return self._plan.bind(kwargs)
+
+    def find(self, **values):
+        return Query(self._manager, self.bind(**values))
+
+    def find_one(self, **values):
+        return self._manager._find_one(self.bind(**values))
+
+
+def merge_query(query, other):
+    "Return new query dict with conditions of both queries"
+    q = query.copy()
+    for k, v in other.iteritems():
+        if k in q and isinstance(q[k], dict) and isinstance(v, dict):
+            q[k] = dict(q[k])
+            q[k].update(v)
         else:
             q[k] = v
+    return q
 
-    # append operator dict to mongo update dict
-    for k, v in op_list.items():
-        for i in v:
-            q['$' + k] = {i[0]: i[1]}
 
-    print 'parsed update query', q
-    return q
+def _lookup(doc, path):
+    "Get value by dotted path, None if missing"
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class Page(list):
+    """Documents of one page. 'next' is continuation token for the
+    following page, None for the last page."""
+    def __init__(self, items, next=None):
+        super(Page, self).__init__(items)
+        self.next = next
+
+
+def _sort_spec(sort):
+    """Normalize sort for paginate(): 'name', '-name', ('name', -1)
+    or list of them  =>  [('name', -1), ...]"""
+    if isinstance(sort, (basestring, tuple)):
+        sort = [sort]
+    spec = []
+    for s in sort:
+        if isinstance(s, basestring):
+            key, direction = s.lstrip('-'), -1 if s.startswith('-') else 1
+        else:
+            key, direction = s
+        spec.append((key.replace('__', '.'), direction))
+    return spec
+
+
+def _seek(spec, values):
+    """Build predicate for docs following values in spec order:
+    (k1 > v1) or (k1 == v1 and k2 > v2) or ..."""
+    alternatives = []
+    for i, (key, direction) in enumerate(spec):
+        condition = dict((k, v) for (k, d), v in zip(spec[:i], values))
+        condition[key] = {'$gt' if direction > 0 else '$lt': values[i]}
+        alternatives.append(condition)
+    return alternatives
 
 
 class Query(DocList):
     """Query - implement query atom"""
 
     def __init__(self, manager, query, **kwargs):
-        self._manager = manager
-        self._query = query.copy()
-        u = parse_query(kwargs)
-        for k, v in u.iteritems():
-            if k in self._query:
-                if isinstance(self._query[k], dict):
-                    self._query[k].update(v)
-                    continue
-            self._query[k] = v
+        super(Query, self).__init__(manager, None)
+        self._query = merge_query(query, parse_query(kwargs))
 
-        self._litems = None
+    def _clone(self, **kwargs):
+        "Return new query with the same options"
+        query = self._derive()
+        if kwargs:
+            query._query = merge_query(self._query, parse_query(kwargs))
+        return query
 
     def find(self, **kwargs):
-        return Query(self._manager, self._query, **kwargs)
+        return self._clone(**kwargs)
+
+    def where(self, *expressions):
+        """Filter by expressions of fields.
+        where(User.age < 30, (User.name == 'x') | (User.name == 'y'))
+        """
+        query = self._clone()
+        compiled = And(*expressions).compile()
+        if set(compiled) & set(self._query):
+            query._query = {'$and': [self._query, compiled]}
+        else:
+            query._query = dict(self._query)
+            query._query.update(compiled)
+        return query
+
+    def prefetch(self, *paths):
+        """Resolve DBRefs by paths in batches instead of one query per ref.
+        prefetch('friends', 'author__profile')
+        """
+        query = self._clone()
+        query._prefetch = self._prefetch + paths
+        return query
+
+    def _project(self, fields, include):
+        "Return query with projection of fields"
+        query = self._clone()
+        projection = {}
+        if self._fields and (1 if include else 0) in self._fields.values():
+            projection.update(self._fields)
+        for f in fields:
+            name = f.name if isinstance(f, Field) else f.replace('__', '.')
+            projection[name] = 1 if include else 0
+        query._fields = projection
+        return query
+
+    def only(self, *fields):
+        """Load only given fields, others are loaded on first access.
+        only('name', User.email, 'person__age')
+        """
+        return self._project(fields, True)
+
+    def defer(self, *fields):
+        """Skip loading of given fields until they are accessed.
+        defer('avatar', User.history)
+        """
+        return self._project(fields, False)
+
+    def raw(self):
+        "Return documents as plain dicts instead of models"
+        query = self._clone()
+        query._row = dict
+        return query
+
+    def lazy(self):
+        """Keep documents as raw BSON, decode fields of models on first
+        access. Documents are decoded as usual when manager uses Router."""
+        query = self._clone()
+        query._lazy = True
+        return query
+
+    def _rows(self, fields, row):
+        "Return query loading only fields and converting docs with row"
+        query = self._clone()
+        paths = [f.name if isinstance(f, Field) else f.replace('__', '.')
+                 for f in fields]
+        query._fields = dict((p, 1) for p in paths)
+        if '_id' not in paths:
+            query._fields['_id'] = 0
+        query._row = lambda doc: row([_lookup(doc, p) for p in paths])
+        return query
+
+    def values(self, *fields):
+        """Return dicts of given fields instead of models.
+        values('name', 'person__age')  =>  {'name': .., 'person__age': ..}
+        """
+        names = [f.name if isinstance(f, Field) else f for f in fields]
+        return self._rows(fields, lambda values: dict(zip(names, values)))
+
+    def values_list(self, *fields, **kwargs):
+        """Return tuples of given fields instead of models.
+        With flat=True and one field return plain values.
+        """
+        if kwargs.get('flat'):
+            if len(fields) != 1:
+                raise TypeError('flat is allowed with one field only')
+            return self._rows(fields, lambda values: values[0])
+        return self._rows(fields, tuple)
+
+    def paginate(self, sort=None, page_size=20, after=None):
+        """Return Page of documents following 'after' token.
+        Unlike skip() the cost does not depend on page depth: the next
+        page starts from the sort key and _id of the previous page's last
+        document. sort is 'name', '-name', ('name', -1) or list of them,
+        sort() of the query is used by default.
+
+        page = manager.find(age__gt=20).paginate('-age', 50)
+        page = manager.find(age__gt=20).paginate('-age', 50, after=page.next)
+        """
+        spec = _sort_spec(sort) if sort is not None else list(self._sort or [])
+        spec = [s for s in spec if s[0] != '_id']
+        spec.append(('_id', spec[-1][1] if spec else 1))
+        keys = [key for key, direction in spec]
+
+        query = self._derive(sort=spec, limit=page_size + 1, skip=None)
+        if after is not None:
+            values = BSON(base64.urlsafe_b64decode(str(after))).decode()['v']
+            seek = _seek(spec, values)
+            if '$or' in query._query:
+                query._query = {'$and': [query._query, {'$or': seek}]}
+            else:
+                query._query = dict(query._query, **{'$or': seek})
+
+        # Sort keys are needed for token even if projection skips them
+        if query._fields:
+            fields = dict(query._fields)
+            if 1 in fields.values():
+                fields.update((key, 1) for key in keys)
+            else:
+                for key in keys:
+                    fields.pop(key, None)
+            query._fields = fields
+
+        docs = list(islice(query._items, page_size + 1))
+        token = None
+        if len(docs) > page_size:
+            docs = docs[:page_size]
+            last = docs[-1]
+            if isinstance(last, str): # raw BSON of lazy() query
+                last = BSON(last).decode()
+            values = [_lookup(last, key) for key in keys]
+            token = base64.urlsafe_b64encode(BSON.encode({'v': values}))
+        return Page(query._convert(docs), token)
+
+    def parallel_map(self, func, workers=None, chunks=None, **kwargs):
+        """Apply func to every document in pool of processes, query is split
+        into _id ranges processed in parallel. See parallel.parallel_map().
+
+        total = manager.find().parallel_map(price, workers=8, reduce=operator.add)
+        """
+        return parallel_map(self, func, workers, chunks, **kwargs)
+
+    def aggregate(self):
+        """Start aggregation pipeline filtered by the query, grouping and
+        computing is done by server. Returns Aggregation.
+
+        query.aggregate().group_by('country').annotate(total=Sum('price'))
+        query.aggregate().unwind('tags').count_by('tags')
+        """
+        return Aggregation(self)
 
     def remove(self):
         "Remove all objects filtered by query chain"
@@ -0,0 +1,353 @@
+"""Pools of database connections and routing of models to them.
+
+Router takes the place of pymongo database in Manager or in
+env.mongo_connection of svarga backend. Writes go to the 'write' pools
+of a collection, reads to its 'read' pools and Query.route('scan')
+style queries to pools of the named kind, e.g. a hidden replica for
+heavy scans.
+
+router = Router({'primary': Pool(Connect('db1', 27017, 'app')),
+                 'replica': Pool(Connect('db2', 27017, 'app'),
+                                 max_in_flight=20)},
+                default={'read': ['replica', 'primary'],
+                         'write': ['primary']})
+router.add_rule(Payment, read='primary')
+users = Manager(router, User)
+"""
+
+import time
+import threading
+
+from pymongo.errors import ConnectionFailure
+
+from aggregation import run_pipeline
+from errors import DatabaseError, PoolTimeout
+
+# Methods of collection served by 'read' pools, others go to 'write' pools
+READS = ('find', 'find_one', 'count', 'aggregate', 'distinct',
+         'index_information', 'options', 'group', 'inline_map_reduce')
+
+
+class Pool(object):
+    """Database of one server with limit of operations in flight.
+    factory() returns pymongo database, e.g. parallel.Connect, it is
+    called on first use and again after a connection failure. Failed
+    pool is skipped by Router for retry_after seconds."""
+    def __init__(self, factory, max_in_flight=None, retry_after=10):
+        self.factory = factory
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self._db = None
+        self._failed_at = None
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.reset()
+
+    def reset(self):
+        "Clear metrics"
+        with self._condition:
+            self.acquired = 0
+            self.waits = 0
+            self.wait_seconds = 0.0
+            self.max_wait = 0.0
+            self.timeouts = 0
+            self.failures = 0
+
+    @property
+    def db(self):
+        db = self._db
+        if db is None:
+            db = self._db = self.factory()
+        return db
+
+    @property
+    def healthy(self):
+        failed_at = self._failed_at
+        return failed_at is None or \
+            time.time() - failed_at >= self.retry_after
+
+    def acquire(self, timeout=None):
+        "Take a slot, wait while max_in_flight operations run"
+        with self._condition:
+            if self.max_in_flight is not None and \
+                    self.in_flight >= self.max_in_flight:
+                start = time.time()
+                self.waits += 1
+                while self.in_flight >= self.max_in_flight:
+                    left = None
+                    if timeout is not None:
+                        left = timeout - (time.time() - start)
+                        if left <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeout('no free slot in %s seconds'
+                                              % timeout)
+                    self._condition.wait(left)
+                waited = time.time() - start
+                self.wait_seconds += waited
+                self.max_wait = max(self.max_wait, waited)
+            self.in_flight += 1
+            self.acquired += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def failed(self):
+        "Mark pool unhealthy, reconnect on next use"
+        self.failures += 1
+        self._failed_at = time.time()
+        self._db = None
+
+    def succeeded(self):
+        self._failed_at = None
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'acquired': self.acquired,
+                'waits': self.waits, 'wait_seconds': self.wait_seconds,
+                'max_wait': self.max_wait, 'timeouts': self.timeouts,
+                'failures': self.failures, 'healthy': self.healthy}
+
+
+class Router(object):
+    """Database-like object sending operations on collections to pools.
+    Rules map kind of operation ('read', 'write' or own kinds used with
+    Query.route()) to names of pools tried in order. Unhealthy pools are
+    tried last, on connection failure the next pool is used. Writes are
+    tried again only when the pool failed to connect, a write failing
+    after it was sent could have been applied. Kinds without a rule use
+    'read' pools. wait_timeout limits waiting for a slot of a pool,
+    PoolTimeout is raised after it."""
+    def __init__(self, pools, default=None, wait_timeout=None):
+        self.pools = dict(pools)
+        self.default = self._rule(default or {'read': ['primary'],
+                                              'write': ['primary']})
+        self.rules = {}
+        self.wait_timeout = wait_timeout
+
+    def _rule(self, kinds):
+        rule = {}
+        for kind, names in kinds.iteritems():
+            if isinstance(names, basestring):
+                names = [names]
+            for name in names:
+                if name not in self.pools:
+                    raise DatabaseError('unknown pool %r' % name)
+            rule[kind] = list(names)
+        return rule
+
+    def add_rule(self, model, **kinds):
+        """Route operations on collection of model, or collection name,
+        router.add_rule(Event, read='analytics', scan='analytics')"""
+        name = model if isinstance(model, basestring) else model._name
+        self.rules[name] = self._rule(kinds)
+
+    def candidates(self, collection, kind):
+        "Pools for operation, healthy ones first"
+        rule = self.rules.get(collection, {})
+        names = rule.get(kind) or self.default.get(kind) or \
+            rule.get('read') or self.default['read']
+        pools = [self.pools[name] for name in names]
+        return [p for p in pools if p.healthy] + \
+            [p for p in pools if not p.healthy]
+
+    def run(self, collection, kind, call, retry=True):
+        """Return call(db) run on the first pool which does not fail.
+        Without retry, failure of call() itself is raised at once."""
+        errors = []
+        for pool in self.candidates(collection, kind):
+            pool.acquire(self.wait_timeout)
+            sent = False
+            try:
+                db = pool.db
+                sent = True
+                result = call(db)
+            except ConnectionFailure, e:
+                pool.failed()
+                if sent and not retry:
+                    raise
+                errors.append(e)
+                continue
+            finally:
+                pool.release()
+            pool.succeeded()
+            return result
+        raise DatabaseError('all pools failed for %s of %s: %s' % (
+            kind, collection, '; '.join(str(e) for e in errors)))
+
+    def route(self, kind):
+        "Database-like view sending all operations to pools of kind"
+        return RoutedDatabase(self, kind)
+
+    def __getitem__(self, name):
+        return RoutedCollection(self, name)
+
+    def dereference(self, dbref):
+        return self.run(dbref.collection, 'read',
+                        lambda db: db.dereference(dbref))
+
+    def command(self, *args, **kwargs):
+        return self.run(None, 'write',
+                        lambda db: db.command(*args, **kwargs), retry=False)
+
+    def stats(self):
+        "Metrics of pools by name"
+        return dict((name, pool.stats())
+                    for name, pool in self.pools.iteritems())
+
+
+class RoutedDatabase(object):
+    "Router bound to one kind of operations"
+    def __init__(self, router, kind):
+        self._router = router
+        self._kind = kind
+
+    def __getitem__(self, name):
+        return RoutedCollection(self._router, name, self._kind)
+
+    def dereference(self, dbref):
+        return self._router.run(dbref.collection, self._kind,
+                                lambda db: db.dereference(dbref))
+
+
+class RoutedCollection(object):
+    """Collection calling methods of collection of the chosen pool.
+    Cursors open on the first read, so their failover happens there."""
+    def __init__(self, router, name, kind=None):
+        self._router = router
+        self.name = name
+        self._kind = kind
+
+    def _kind_of(self, method):
+        if self._kind is not None:
+            return self._kind
+        return 'read' if method in READS else 'write'
+
+    def find(self, *args, **kwargs):
+        return RoutedCursor(self._router, self.name, self._kind_of('find'),
+                            args, kwargs)
+
+    def aggregate(self, pipeline):
+        name = self.name
+        return self._router.run(
+            name, self._kind_of('aggregate'),
+            lambda db: run_pipeline(db[name], db, pipeline))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        name, kind = self.name, self._kind_of(method)
+        retry = method in READS
+
+        def call(*args, **kwargs):
+            return self._router.run(
+                name, kind, lambda db: getattr(db[name], method)(*args,
+                                                                 **kwargs),
+                retry)
+        call.__name__ = method
+        return call
+
+
+def _chain(name):
+    "Record cursor option, applied to cursor of every pool tried"
+    def wrapper(self, *args, **kwargs):
+        if self._cursor is not None:
+            raise DatabaseError('cursor is already open')
+        self._options.append((name, args, kwargs))
+        return self
+    wrapper.__name__ = name
+    return wrapper
+
+
+class RoutedCursor(object):
+    """Cursor holding a slot of its pool from the first read until it is
+    exhausted or collected. Pool failing before the first document is
+    replaced by the next one."""
+    def __init__(self, router, collection, kind, args, kwargs):
+        self._router = router
+        self._collection = collection
+        self._kind = kind
+        self._find = (args, kwargs)
+        self._options = []
+        self._cursor = None
+        self._pool = None
+
+    sort = _chain('sort')
+    skip = _chain('skip')
+    limit = _chain('limit')
+    hint = _chain('hint')
+    batch_size = _chain('batch_size')
+
+    def _build(self, db):
+        args, kwargs = self._find
+        cursor = db[self._collection].find(*args, **kwargs)
+        for name, args, kwargs in self._options:
+            cursor = getattr(cursor, name)(*args, **kwargs)
+        return cursor
+
+    def _open(self):
+        "Open cursor on the first pool not failing, return first doc"
+        errors = []
+        for pool in self._router.candidates(self._collection, self._kind):
+            pool.acquire(self._router.wait_timeout)
+            try:
+                cursor = self._build(pool.db)
+                doc = cursor.next()
+            except StopIteration:
+                pool.release()
+                pool.succeeded()
+                self._cursor = iter(())
+                raise
+            except ConnectionFailure, e:
+                pool.release()
+                pool.failed()
+                errors.append(e)
+                continue
+            except:
+                pool.release()
+                raise
+            pool.succeeded()
+            self._cursor, self._pool = cursor, pool
+            return doc
+        raise DatabaseError('all pools failed for %s of %s: %s' % (
+            self._kind, self._collection,
+            '; '.join(str(e) for e in errors)))
+
+    def _release(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.release()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._cursor is None:
+            return self._open()
+        try:
+            return self._cursor.next()
+        except StopIteration:
+            self._release()
+            raise
+        except ConnectionFailure:
+            pool = self._pool
+            self._release()
+            if pool is not None:
+                pool.failed()
+            raise
+
+    def close(self):
+        self._release()
+        self._cursor = iter(())
+
+    def count(self, *args, **kwargs):
+        return self._router.run(
+            self._collection, self._kind,
+            lambda db: self._build(db).count(*args, **kwargs))
+
+    def explain(self):
+        return self._router.run(self._collection, self._kind,
+                                lambda db: self._build(db).explain())
+
+    def __del__(self):
+        self._release()
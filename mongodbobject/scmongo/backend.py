@@ -6,6 +6,7 @@ from svarga.utils.imports import import_module
 import pymongo
 from pymongo.son_manipulator import AutoReference, NamespaceInjector
 from mongomodels import Model, Manager, MetaModel
+from mongomodels.models import MongoModels
 
 class ScManager(Manager, models.BaseModelManager):
     "Mix of managers"
@@ -26,13 +27,6 @@ class ScMetaModel(MetaModel):
 
         model.__table__ = classname
         model.objects = ScManager(model)
-
-        # Process fields
-        for field in model._fields.values():
-            # Set order in db
-            if field.order:
-                model.objects.collection.create_index([(field.name, field.order)])
-        
         model.Meta.update()
 
         return model
@@ -54,7 +48,9 @@ class MongoBackend(object):
 
     def __init__(self, apps, env_class):
         db_name = getattr(env_class.settings, 'MONGO_DB')
-        env_class.mongo_connection = pymongo.Connection()[db_name]
+        # MONGO_ROUTER is a mongomodels.Router spreading models over pools
+        router = getattr(env_class.settings, 'MONGO_ROUTER', None)
+        env_class.mongo_connection = router or pymongo.Connection()[db_name]
         #env_class.mongo_connection.add_son_manipulator(NamespaceInjector())
 
         # Try loading models from app's models.py
@@ -73,5 +69,6 @@ class MongoBackend(object):
         return type(prefix+'ScMongoModel', (ScMongoModel, ), {'_prefix': prefix, '_base_model': True})
 
     def sync_db(self):
-        pass
+        "Build missing indexes of all models"
+        MongoModels.ensure_indexes(env.mongo_connection)
 
@@ -0,0 +1,309 @@
+"Unit of work buffering writes of managers"
+
+import threading
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from errors import DatabaseError, BulkWriteError
+from models import to_mongo, _snapshot
+
+# Update operators which can be combined
+MERGEABLE = ('$set', '$unset', '$inc')
+
+_local = threading.local()
+
+
+def current(manager):
+    "Session open for manager in this thread, None if there is none"
+    sessions = getattr(_local, 'sessions', None)
+    if not sessions:
+        return None
+    return sessions.get(manager)
+
+
+def _target(spec):
+    "_id selected by spec, None if spec could select other documents"
+    if isinstance(spec, dict) and spec.keys() == ['_id'] and \
+            not isinstance(spec['_id'], dict):
+        return spec['_id']
+    return None
+
+
+def merge_updates(first, second):
+    """Combine two updates of the same documents into one, or return None
+    if they can not be combined: $inc of a path are summed, the last
+    $set or $unset of a path wins over earlier changes of it."""
+    if not all(op in MERGEABLE for op in first) or \
+            not all(op in MERGEABLE for op in second):
+        return None
+    merged = dict((op, dict(paths)) for op, paths in first.iteritems())
+    for op, paths in second.iteritems():
+        for path, value in paths.iteritems():
+            related = [(o, p) for o, ps in merged.iteritems() for p in ps
+                       if p == path or p.startswith(path + '.') or
+                       path.startswith(p + '.')]
+            if op == '$inc':
+                if related == [('$inc', path)]:
+                    merged['$inc'][path] += value
+                    continue
+                if related:
+                    return None
+            else:
+                if any(path.startswith(p + '.') for o, p in related):
+                    return None # change inside a replaced value
+                for o, p in related:
+                    del merged[o][p]
+            merged.setdefault(op, {})[path] = value
+    return dict((op, paths) for op, paths in merged.iteritems() if paths)
+
+
+class _Op(object):
+    "Buffered write: save of model, update or remove by spec"
+    __slots__ = ('manager', 'kind', 'spec', 'payload', 'models', 'frozen',
+                 'state')
+
+    def __init__(self, manager, kind, spec, payload=None):
+        self.manager = manager
+        self.kind = kind
+        self.spec = spec
+        self.payload = payload
+        self.models = [] # post_save() is called for every save() call
+        self.frozen = None # (kind, payload) of save taken before later ops
+        self.state = None # (_persisted, _changes) of model before freeze
+
+    def target(self):
+        if self.kind == 'save':
+            return dict.get(self.payload, '_id')
+        return _target(self.spec)
+
+
+class Session(object):
+    """Unit of work of managers. While it is open, save(), delete() and
+    updates and removes of queries of the managers are buffered in this
+    thread and written when the outermost block exits without exception.
+
+    Repeated saves of a model are written once, at the place of its first
+    save, unless an update or remove which could touch the document comes
+    between them: then the first save is taken as it was and later saves
+    write changes made since. Updates of the same _id are merged. Writes
+    to a collection keep their order. Runs of inserts go as one batch,
+    runs of removes by _id as one $in remove, every write is acknowledged.
+    pre_save() and pre_delete() are called at once, post_save() after the
+    write. Reads do not see buffered writes.
+
+    with users.session(posts):
+        users.save(user)
+        users.find(_id=user._id).update(inc__visits=1)
+        posts.delete(post)
+    """
+    def __init__(self, managers):
+        self.managers = list(managers)
+        self._depth = 0
+        self._ops = []
+        self._saves = {}
+
+    def __enter__(self):
+        if self._depth == 0:
+            sessions = _local.__dict__.setdefault('sessions', {})
+            for manager in self.managers:
+                if sessions.get(manager, self) is not self:
+                    raise DatabaseError('session of %s is already open'
+                                        % manager.model_class._name)
+            for manager in self.managers:
+                sessions[manager] = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._depth -= 1
+        if self._depth:
+            return
+        for manager in self.managers:
+            _local.sessions.pop(manager, None)
+        if type is None:
+            self.flush()
+        else:
+            self.clear()
+
+    def save(self, manager, model):
+        model.pre_save()
+        if '_id' not in model:
+            model._id = ObjectId()
+        op = self._saves.get(id(model))
+        if op is None:
+            op = self._saves[id(model)] = _Op(manager, 'save', None, model)
+            self._ops.append(op)
+        op.models.append(model)
+        return model._id
+
+    def delete(self, manager, model):
+        model.pre_delete()
+        if '_id' not in model:
+            return
+        op = self._saves.pop(id(model), None)
+        if op is not None:
+            self._ops.remove(op)
+        self._freeze(manager, model._id)
+        self._ops.append(_Op(manager, 'remove', {'_id': model._id}))
+        del model['_id']
+        object.__setattr__(model, '_persisted', False)
+
+    def update(self, manager, spec, update):
+        _id = _target(spec)
+        self._freeze(manager, _id)
+        if _id is None: # the first update may change what spec matches
+            self._ops.append(_Op(manager, 'update', spec, update))
+            return
+        for op in reversed(self._ops):
+            if op.manager is not manager:
+                continue
+            if op.kind == 'update' and op.spec == spec:
+                merged = merge_updates(op.payload, update)
+                if merged is not None:
+                    op.payload = merged
+                    return
+                break
+            target = op.target()
+            if target is None or target == _id:
+                break
+        self._ops.append(_Op(manager, 'update', spec, update))
+
+    def remove(self, manager, spec):
+        self._freeze(manager, _target(spec))
+        self._ops.append(_Op(manager, 'remove', spec))
+
+    def _freeze(self, manager, _id):
+        """Freeze pending saves of documents which the next op, selecting
+        _id or any document if None, could change. Their models are marked
+        saved, so their next save() adds a new op."""
+        for key, op in self._saves.items():
+            model = op.payload
+            if op.manager is not manager or \
+                    (_id is not None and model._id != _id):
+                continue
+            kind, payload = self._save_write(model)
+            if kind == 'update':
+                payload = (payload[0], _snapshot(payload[1]))
+            elif payload is not None:
+                payload = _snapshot(payload)
+            op.frozen = (kind, payload)
+            op.state = (model._persisted, model._changes)
+            object.__setattr__(model, '_persisted', True)
+            model._reset_changes()
+            del self._saves[key]
+
+    def _thaw(self, ops):
+        "Restore models of frozen saves which were not written"
+        for op in reversed(ops):
+            if op.frozen is not None:
+                model = op.payload
+                persisted, changes = op.state
+                changes = dict(changes)
+                changes.update(model._changes)
+                object.__setattr__(model, '_persisted', persisted)
+                object.__setattr__(model, '_changes', changes)
+
+    def clear(self):
+        "Drop buffered writes"
+        self._thaw(self._ops)
+        self._ops = []
+        self._saves = {}
+
+    def _save_write(self, model):
+        "Write of model as it is now: (kind, payload)"
+        if not model._persisted:
+            return 'insert', to_mongo(model)
+        update = model._get_update()
+        if update is None:
+            model._load_deferred() # never overwrite doc with partial one
+            return 'save', to_mongo(model)
+        if update:
+            return 'update', ({'_id': model._id}, update)
+        return 'none', None # saved without changes, only hooks are called
+
+    def _batches(self, ops):
+        "Group ops of one manager into writes: [kind, payload, ops]"
+        batches = []
+        for op in ops:
+            last = batches[-1] if batches else [None]
+            if op.kind == 'save':
+                kind, payload = op.frozen or self._save_write(op.payload)
+                if kind == 'insert' and last[0] == 'insert':
+                    last[1].append(payload)
+                    last[2].append(op)
+                elif kind == 'insert':
+                    batches.append(['insert', [payload], [op]])
+                else:
+                    batches.append([kind, payload, [op]])
+            elif op.kind == 'remove' and _target(op.spec) is not None:
+                if last[0] == 'remove_ids':
+                    last[1].append(op.spec['_id'])
+                    last[2].append(op)
+                else:
+                    batches.append(['remove_ids', [op.spec['_id']], [op]])
+            else:
+                batches.append([op.kind, (op.spec, op.payload), [op]])
+        return batches
+
+    def _write(self, manager, kind, payload):
+        collection = manager.collection
+        if kind == 'insert':
+            manager._measure('insert', None,
+                             lambda: collection.insert(payload, safe=True),
+                             written=payload)
+        elif kind == 'save':
+            manager._measure('save', {'_id': payload['_id']},
+                             lambda: collection.save(payload, safe=True),
+                             written=[payload])
+        elif kind == 'update':
+            spec, update = payload
+            manager._measure('update', spec,
+                             lambda: collection.update(spec, update,
+                                                       safe=True),
+                             written=[update])
+        elif kind == 'remove_ids':
+            spec = {'_id': {'$in': payload}} if len(payload) > 1 \
+                else {'_id': payload[0]}
+            manager._measure('remove', spec,
+                             lambda: collection.remove(spec, safe=True))
+        elif kind == 'remove':
+            spec = payload[0]
+            manager._measure('remove', spec,
+                             lambda: collection.remove(spec, safe=True))
+
+    def flush(self):
+        """Write buffered operations, collection after collection in order
+        of their first write. The first failed write stops the flush and
+        is raised as BulkWriteError, following writes are dropped."""
+        ops, managers = self._ops, []
+        self._ops, self._saves = [], {}
+        for op in ops:
+            if op.manager not in managers:
+                managers.append(op.manager)
+
+        # Documents are validated before anything is written
+        plan = [(manager, self._batches([op for op in ops
+                                         if op.manager is manager]))
+                for manager in managers]
+
+        number, written = 0, set()
+        for manager, batches in plan:
+            try:
+                for kind, payload, batch_ops in batches:
+                    try:
+                        self._write(manager, kind, payload)
+                    except OperationFailure, e:
+                        self._thaw([op for op in ops if op not in written])
+                        raise BulkWriteError([(number, [
+                            op.payload for op in batch_ops
+                            if op.kind == 'save'], e)])
+                    number += 1
+                    for op in batch_ops:
+                        written.add(op)
+                        if op.kind == 'save' and op.frozen is None:
+                            manager._saved(op.payload)
+                        for model in op.models:
+                            model.post_save()
+            finally:
+                manager._invalidate()
@@ -0,0 +1,289 @@
+"Write-behind queue of managers flushed by a background thread"
+
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+from bson.objectid import ObjectId
+
+from errors import QueueFull
+from models import to_mongo, _snapshot
+from session import merge_updates, _target
+
+# Markers put into queue by flush(), with its event, and close()
+_FLUSH, _STOP = object(), object()
+
+
+class WriteBehind(object):
+    """Bounded queue of writes returning at once, for data which may be
+    lost, e.g. activity logs and counters. Managers with write_behind
+    queue save(), delete() and updates and removes of queries; documents
+    and updates are copied through BSON when queued, later changes of
+    models do not reach the queue. A background thread writes them in batches
+    of batch_size or what was queued in interval seconds. Inserts of a
+    batch go together and updates of the same _id are merged.
+
+    When the queue is full, on_full='block' waits up to timeout seconds,
+    'drop' drops the write and 'raise' raises QueueFull. Failed writes
+    are passed to on_error(error, manager, kind, payloads) and dropped,
+    errors of post_save() hooks with kind 'post_save' and the model.
+
+    queue = WriteBehind(max_size=10000, batch_size=500, interval=0.5)
+    events = Manager(db, Event, write_behind=queue)
+    events.save(Event(action='login'))
+    ...
+    queue.close()
+    """
+    def __init__(self, max_size=10000, batch_size=500, interval=1.0,
+                 on_full='block', timeout=None, on_error=None):
+        if on_full not in ('block', 'drop', 'raise'):
+            raise ValueError('on_full must be block, drop or raise')
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_full = on_full
+        self.timeout = timeout
+        self.on_error = on_error
+        self._queue = Queue.Queue(max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Clear metrics"
+        self._started = time.time()
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self.write_seconds = 0.0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _put(self, item):
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            if self.on_full == 'drop':
+                with self._lock:
+                    self.dropped += 1
+                return False
+            if self.on_full == 'raise':
+                raise QueueFull('write-behind queue is full')
+            with self._lock:
+                self.blocked += 1
+            try:
+                self._queue.put(item, True, self.timeout)
+            except Queue.Full:
+                raise QueueFull('write-behind queue is full for %s seconds'
+                                % self.timeout)
+        with self._lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def save(self, manager, model):
+        "Queue insert, update or whole save of model, return its _id"
+        model.pre_save()
+        update = model._get_update()
+        if update is None:
+            if '_id' not in model:
+                model._id = ObjectId()
+            model._load_deferred()
+            kind = 'save' if model._persisted else 'insert'
+            payload = _snapshot(to_mongo(model))
+        elif update:
+            kind, payload = 'update', ({'_id': model._id}, _snapshot(update))
+        else:
+            kind, payload = None, None
+        if kind is None or self._put((manager, kind, payload, model)):
+            manager._saved(model)
+        return model._id
+
+    def delete(self, manager, model):
+        model.pre_delete()
+        if '_id' in model:
+            self._put((manager, 'remove', {'_id': model._id}, None))
+            del model['_id']
+            object.__setattr__(model, '_persisted', False)
+
+    def update(self, manager, spec, update):
+        self._put((manager, 'update', (_snapshot(spec), _snapshot(update)),
+                   None))
+
+    def remove(self, manager, spec):
+        self._put((manager, 'remove', _snapshot(spec), None))
+
+    def flush(self):
+        "Wait until everything queued so far is written"
+        if self._thread is not None:
+            self._start()
+            done = threading.Event()
+            self._queue.put((_FLUSH, done))
+            done.wait()
+
+    def close(self):
+        "Write queued writes and stop the thread"
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        elapsed = time.time() - self._started
+        return {'depth': self._queue.qsize(), 'max_depth': self.max_depth,
+                'enqueued': self.enqueued, 'written': self.written,
+                'batches': self.batches, 'errors': self.errors,
+                'dropped': self.dropped, 'blocked': self.blocked,
+                'write_seconds': self.write_seconds,
+                'written_per_sec': self.written / elapsed if elapsed else 0.0}
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, done = [], None
+            item = self._queue.get()
+            deadline = time.time() + self.interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                if item[0] is _FLUSH:
+                    done = item[1]
+                    break
+                batch.append(item)
+                left = deadline - time.time()
+                if len(batch) >= self.batch_size or left <= 0:
+                    break
+                try:
+                    item = self._queue.get(True, left)
+                except Queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception: # the thread must keep writing
+                traceback.print_exc()
+            finally:
+                if done is not None:
+                    done.set()
+
+    def _plan(self, batch):
+        "Group queued writes into runs: [manager, kind, payloads, models]"
+        runs = []
+        for manager, kind, payload, model in batch:
+            if kind == 'update' and self._merge(runs, manager, payload,
+                                                model):
+                continue
+            last = runs[-1] if runs else None
+            if kind == 'insert' and last is not None and \
+                    last[0] is manager and last[1] == 'insert':
+                last[2].append(payload)
+                last[3].append(model)
+            else:
+                runs.append([manager, kind, [payload], [model]])
+        return runs
+
+    def _merge(self, runs, manager, payload, model):
+        "Merge update into earlier update of the same _id if possible"
+        spec, update = payload
+        _id = _target(spec)
+        if _id is None: # the first update may change what spec matches
+            return False
+        for run in reversed(runs):
+            if run[0] is not manager:
+                continue
+            kind, payloads = run[1], run[2]
+            if kind == 'update' and payloads[0][0] == spec:
+                merged = merge_updates(payloads[0][1], update)
+                if merged is None:
+                    return False
+                payloads[0] = (spec, merged)
+                run[3].append(model)
+                return True
+            if kind in ('insert', 'save'):
+                targets = [doc.get('_id') for doc in payloads]
+            elif kind == 'update':
+                targets = [_target(payloads[0][0])]
+            else:
+                targets = [_target(payloads[0])]
+            if None in targets or _id in targets:
+                return False
+        return False
+
+    def _send(self, manager, kind, payloads):
+        collection = manager.collection
+        if kind == 'insert':
+            manager._measure('insert', None,
+                             lambda: collection.insert(payloads, safe=True),
+                             written=payloads)
+        elif kind == 'save':
+            doc = payloads[0]
+            manager._measure('save', {'_id': doc['_id']},
+                             lambda: collection.save(doc, safe=True),
+                             written=[doc])
+        elif kind == 'update':
+            spec, update = payloads[0]
+            manager._measure('update', spec,
+                             lambda: collection.update(spec, update,
+                                                       safe=True),
+                             written=[update])
+        else:
+            spec = payloads[0]
+            manager._measure('remove', spec,
+                             lambda: collection.remove(spec, safe=True))
+
+    def _write(self, batch):
+        start = time.time()
+        managers = []
+        try:
+            runs = self._plan(batch)
+        except Exception: # e.g. $inc of a string, write one by one
+            runs = [[manager, kind, [payload], [model]]
+                    for manager, kind, payload, model in batch]
+        for manager, kind, payloads, models in runs:
+            if manager not in managers:
+                managers.append(manager)
+            try:
+                self._send(manager, kind, payloads)
+            except Exception, e:
+                self.errors += 1
+                self._failed(e, manager, kind, payloads)
+                continue
+            self.written += len(payloads)
+            for model in models:
+                if model is not None:
+                    try:
+                        model.post_save()
+                    except Exception, e:
+                        self._failed(e, manager, 'post_save', [model])
+        for manager in managers:
+            try:
+                manager._invalidate()
+            except Exception, e:
+                self._failed(e, manager, 'invalidate', [])
+        self.batches += 1
+        self.write_seconds += time.time() - start
+
+    def _failed(self, error, manager, kind, payloads):
+        "Report failed write, print it without on_error"
+        if self.on_error is None:
+            sys.stderr.write('write-behind %s of %d doc(s) to %s failed: %r\n'
+                             % (kind, len(payloads),
+                                manager.model_class._name, error))
+            return
+        try:
+            self.on_error(error, manager, kind, payloads)
+        except Exception: # the thread must keep writing
+            traceback.print_exc()
@@ -1,14 +1,45 @@
 # -*- coding:  utf-8 -*-
 
+import copy
+import operator
 import pymongo
 import unittest
 from mongodbobject import *
+from mongodbobject.errors import BulkWriteError, PoolTimeout, ValidationError
 
 class User(Model):
+    age = Field(int)
+    name = Field(unicode)
 
     def upper_name(self):
         return  self.name.upper()
 
+class Account(Model):
+    email = Field(unicode)
+    created = Field(int, order=Field.DESCENDING)
+    _indexes = [Index(email, unique=True), Index('country', '-created')]
+
+class Slug(Field):
+    def process_model(self, model):
+        if self.name not in model and model.get('name'):
+            model[self.name] = model['name'].lower()
+
+class Player(Model):
+    name = Field(unicode)
+    score = Field(float, default=0.0)
+    team = Field(User)
+    slug = Slug(unicode)
+
+class Login(Model):
+    name = Field(unicode)
+
+    def post_save(self):
+        if self.name == u'bad':
+            raise ValueError('hook failed')
+
+def age(document):
+    return document.age
+
 class TestMongoModels(unittest.TestCase):
     def setUp(self):
         self.test_dict = {
@@ -38,6 +69,407 @@ class TestMongoModels(unittest.TestCase):
         #self.assertEqual(str(document._id), str(document2._id))
         self.assertEqual(document.upper_name(), self.test_dict['name'].upper())
 
+    def testCopy(self):
+        manager = Manager(self.collection, User)
+        manager.save(User(self.test_dict))
+        document = manager.find_one(name=u'john')
+        document.me.age = 25
+        copied = copy.copy(document)
+        self.assertEqual(copied, document)
+        copied.me.gender = u'female'
+        self.assertEqual(document.me.gender, u'male')
+        deep = copy.deepcopy(document)
+        deep.friends.append(u'jim')
+        self.assertEqual(len(document.friends), 3)
+        manager.save(copied)
+        self.assertEqual(manager.find_one(name=u'john').me,
+                         {u'age': 25, u'gender': u'female'})
+
+    def testPrefetch(self):
+        manager = Manager(self.collection, User)
+        friends = [User(name=name) for name in self.test_dict['friends']]
+        for friend in friends:
+            manager.save(friend)
+        manager.save(User(name=self.test_dict['name'], friends=friends))
+        document = manager.find(name=self.test_dict['name']).prefetch('friends').next()
+        self.assertEqual([f.name for f in document.friends], self.test_dict['friends'])
+        self.assertEqual(manager.dereference_many(manager.find_one(_id=document._id).friends)[0].name,
+                         self.test_dict['friends'][0])
+
+    def testIdentityMap(self):
+        identity_map = IdentityMap(size=10)
+        manager = Manager(self.collection, User, identity_map=identity_map)
+        _id = manager.save(User(name=self.test_dict['name']))
+        self.assertTrue(manager.get(_id=_id) is manager.find_one(_id=_id))
+        self.assertEqual(identity_map.stats['hits'], 1)
+        manager.find(_id=_id).update(set__name='mike')
+        self.assertEqual(manager.get(_id=_id).name, 'mike')
+
+    def testPartialSave(self):
+        manager = Manager(self.collection, User)
+        _id = manager.save(User(self.test_dict))
+        document = manager.find_one(_id=_id)
+        document.me.age = 25
+        del document.name
+        document.friends.append(u'jim')
+        self.assertEqual(document._get_update(), {
+            '$set': {'me.age': 25, 'friends': self.test_dict['friends'] + [u'jim']},
+            '$unset': {'name': 1}})
+        manager.save(document)
+        document = manager.find_one(_id=_id)
+        self.assertEqual(document.me.age, 25)
+        self.assertFalse('name' in document)
+        self.assertEqual(document._get_update(), {})
+
+    def testOnlyDefer(self):
+        manager = Manager(self.collection, User)
+        manager.save(User(self.test_dict))
+        document = manager.find().only('name', 'me__age').next()
+        self.assertEqual(sorted(dict.keys(document)), ['_id', u'me', u'name'])
+        self.assertEqual(document.me.gender, self.test_dict['me']['gender'])
+        self.assertEqual(document.friends, self.test_dict['friends'])
+        document = manager.find().defer('friends').next()
+        self.assertFalse('friends' in document)
+        self.assertEqual(document.friends, self.test_dict['friends'])
+
+    def testSaveMany(self):
+        manager = Manager(self.collection, User)
+        documents = [User(name=name) for name in self.test_dict['friends']]
+        manager.save_many(documents, batch_size=2)
+        self.assertEqual(manager.find().count(), 3)
+        self.assertEqual(manager.get(_id=documents[2]._id).name, u'elliot')
+        manager.upsert_many([User(name=u'mike', age=30), User(name=u'jim')], key='name')
+        self.assertEqual(manager.find().count(), 4)
+        self.assertEqual(manager.find_one(name=u'mike').age, 30)
+        accounts = Manager(self.collection, Account)
+        accounts.ensure_indexes()
+        accounts.save(Account(email=u'jack@example.com', created=1))
+        jack = Account(email=u'jack@example.com', created=2)
+        jim = Account(email=u'jim@example.com', created=3)
+        try:
+            accounts.upsert_many([jack, jim], key='created', batch_size=1,
+                                  ordered=False)
+        except BulkWriteError, e:
+            self.assertEqual([models for n, models, error in e.errors], [[jack]])
+        else:
+            self.fail('duplicate email was stored')
+        self.assertEqual((jack._persisted, jim._persisted), (False, True))
+
+    def testValues(self):
+        manager = Manager(self.collection, User)
+        manager.save(User(self.test_dict))
+        self.assertEqual(type(manager.find().raw().next()), dict)
+        self.assertEqual(manager.find().values('name', 'me__age').next(),
+                         {'name': u'john', 'me__age': 24})
+        self.assertEqual(manager.find().sort(name=1).values_list('me__age', flat=True).list(), [24])
+
+    def testIterBatches(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(n=i) for i in range(25)])
+        batches = list(manager.find().sort(n=1).iter_batches(10))
+        self.assertEqual([len(b) for b in batches], [10, 10, 5])
+        self.assertEqual(batches[1][0].n, 10)
+
+    def testPaginate(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(n=i % 3) for i in range(7)])
+        pages, token = [], None
+        while True:
+            page = manager.find().paginate('-n', 3, after=token)
+            pages.append([d.n for d in page])
+            token = page.next
+            if token is None:
+                break
+        self.assertEqual(pages, [[2, 2, 1], [1, 0, 0], [0]])
+        page = manager.find().lazy().paginate('-n', 3)
+        page = manager.find().lazy().paginate('-n', 3, after=page.next)
+        self.assertEqual([d.n for d in page], [1, 0, 0])
+
+    def testParallelMap(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(age=i) for i in range(20)])
+        self.assertEqual(sorted(manager.find().parallel_map(age, workers=2, chunks=3)),
+                         range(20))
+        self.assertEqual(manager.find(age__lt=10).parallel_map(age, workers=2, reduce=operator.add),
+                         45)
+        self.assertRaises(ValueError, manager.find().limit(10).parallel_map, age)
+
+    def testPrepare(self):
+        manager = Manager(self.collection, User)
+        manager.save(User(self.test_dict))
+        by_age = manager.prepare(me__age__gt=0, me__age__lt=100)
+        self.assertEqual(by_age.find(me__age__gt=20).count(), 1)
+        self.assertEqual(by_age.find_one(me__age__lt=24), None)
+        manager.find().update(set__name=u'jim', set__me__age=30, inc__visits=1)
+        document = manager.find_one(name=u'jim')
+        self.assertEqual((document.me.age, document.visits), (30, 1))
+
+    def testWhere(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(name=name, age=i) for i, name in
+                           enumerate(self.test_dict['friends'])])
+        either = (User.name == u'mike') | (User.name == u'elliot')
+        self.assertEqual([d.name for d in manager.where(User.age < 2, either)], [u'mike'])
+        self.assertEqual(manager.find(age__gt=0).where(either).count(), 1)
+        self.assertTrue(either.matches(User(name=u'elliot')))
+        self.assertFalse((User.age >= 1).matches(User(age=0)))
+        either.compile()['$or'].append({'name': u'dwight'})
+        self.assertEqual(len(either.compile()['$or']), 2)
+
+    def testResultCache(self):
+        cache = ResultCache(MemoryBackend(size=10, ttl=60))
+        manager = Manager(self.collection, User, result_cache=cache)
+        manager.save(User(self.test_dict))
+        self.assertEqual(manager.find(name=u'john').count(), 1)
+        self.assertEqual(len(manager.find(name=u'john').list()), 1)
+        self.assertEqual(manager.find(name=u'john').count(), 1)
+        self.assertEqual(len(manager.find(name=u'john').list()), 1)
+        # list() takes len() of the query, so counts hit the cache too
+        self.assertEqual(cache.stats['hits'], 4)
+        manager.find(name=u'john').raw().next()['friends'].append(u'jim')
+        self.assertEqual(manager.find(name=u'john').next().friends,
+                         self.test_dict['friends'])
+        manager.find(name=u'john').remove()
+        self.assertEqual(manager.find(name=u'john').count(), 0)
+
+    def testMaterialize(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(name=name, age=i) for i, name in
+                           enumerate(self.test_dict['friends'])])
+        users = manager.find().sort(age=1).materialize(max_docs=10)
+        self.assertEqual(len(users), 3)
+        self.assertEqual([u.age for u in users], [0, 1, 2])
+        self.assertEqual([u.age for u in users], [0, 1, 2])
+        self.assertEqual(users[1].name, u'dwight')
+        self.assertEqual([u.age for u in users[1:]], [1, 2])
+        streamed = manager.find().sort(age=1).materialize(max_docs=1)
+        self.assertEqual([u.age for u in streamed], [0, 1, 2])
+        self.assertEqual([u.age for u in streamed], [0, 1, 2])
+        self.assertEqual(manager.find().sort(age=1)[2].age, 2)
+
+    def testAggregate(self):
+        manager = Manager(self.collection, User)
+        manager.save_many([User(name=name, age=i) for i, name in
+                           enumerate([u'mike', u'mike', u'dwight'])])
+        rows = manager.find(age__gte=0).aggregate().group_by('name') \
+                      .annotate(total=Sum('age'), n=Count()).sort(name=1)
+        self.assertEqual(rows.list(), [{'name': u'dwight', 'total': 2, 'n': 1},
+                                       {'name': u'mike', 'total': 1, 'n': 2}])
+        self.assertEqual(manager.aggregate().count_by(User.name).list()[0],
+                         {'name': u'mike', 'count': 2})
+        self.assertEqual(manager.aggregate().annotate(top=Max('age')).list(),
+                         [{'top': 2}])
+
+    def testInstrumentation(self):
+        instrumentation = Instrumentation(slow_ms=0)
+        finished = []
+        instrumentation.add_post_hook(lambda op: finished.append(op.name))
+        manager = Manager(self.collection, User, instrumentation=instrumentation)
+        manager.save(User(self.test_dict))
+        self.assertEqual(len(manager.find(name=u'john').list()), 1)
+        self.assertEqual(manager.find_one(name=u'john').name, u'john')
+        stats = instrumentation.stats()
+        self.assertEqual(stats[('User', 'find')]['docs'], 1)
+        self.assertEqual(stats[('User', 'construct')]['calls'], 1)
+        self.assertEqual(stats[('User', 'find_one')]['calls'], 1)
+        self.assertEqual(finished[0], 'save')
+        slow = [e for e in instrumentation.slow_log if e['op'] == 'find_one']
+        self.assertEqual(slow[0]['shape'], {'name': '?'})
+        self.assertTrue('plan' in slow[0])
+        john = manager.find_one(name=u'john')
+        manager.find_one(_id=john._id)
+        slow = [e for e in instrumentation.slow_log if e['op'] == 'find_one']
+        self.assertEqual(slow[-1]['shape'], {'_id': '?'})
+        self.assertFalse('error' in slow[-1]['plan'])
+        documents = manager.find(name=u'john')
+        documents.next()
+        del documents # dropped cursors are not explained
+        self.assertEqual(instrumentation.slow_log[-1]['op'], 'find')
+        self.assertFalse('plan' in instrumentation.slow_log[-1])
+
+    def testEnsureIndexes(self):
+        manager = Manager(self.collection, Account)
+        self.assertEqual(len(manager.index_diff()[0]), 3)
+        self.assertEqual(sorted(manager.ensure_indexes()),
+                         ['country_1_created_-1', 'created_-1', 'email_1'])
+        self.assertEqual(manager.ensure_indexes(), [])
+        self.assertTrue(manager.collection.index_information()['email_1']['unique'])
+
+    def testIndexAdvisor(self):
+        advisor = IndexAdvisor(sample_rate=1)
+        manager = Manager(self.collection, Account, advisor=advisor)
+        manager.ensure_indexes()
+        manager.save(Account(email=u'jack@example.com', country=u'de', created=1))
+        manager.find(country=u'de').sort(created=-1).list()
+        manager.find(country=u'de').sort(email=1).list()
+        manager.find(name=u'jack').list()
+        report = dict((repr(row['shape']), row) for row in advisor.report())
+        self.assertFalse('eq(country) sort(-created)' in report)
+        self.assertTrue(report['eq(country) sort(email)']['in_memory_sort'])
+        self.assertTrue(report['eq(name)']['scan'])
+        self.assertEqual(report['eq(name)']['suggest'].spec, [('name', 1)])
+
+    def testAsyncManager(self):
+        users = AsyncManager(self.collection, User, max_concurrency=4)
+        user = User(self.test_dict)
+        users.save(user).result(5)
+        self.assertEqual(users.find(name=u'john').count().result(5), 1)
+        self.assertEqual(users.find_one(name=u'john').result(5).name, u'john')
+        query = users.find(name=u'john')
+        self.assertEqual(len(query.next_batch(10).result(5)), 1)
+        self.assertEqual(query.next_batch(10).result(5), [])
+        refs = [pymongo.dbref.DBRef('User', user._id)] * 3
+        models = gather(users.dereference(ref) for ref in refs).result(5)
+        self.assertEqual([m.name for m in models], [u'john'] * 3)
+        users.find(name=u'john').update(set__name=u'jack').result(5)
+        users.find(name=u'jack').remove().result(5)
+        self.assertEqual(users.find().count().result(5), 0)
+        users.shutdown()
+
+    def testFieldTypes(self):
+        users = Manager(self.collection, User)
+        players = Manager(self.collection, Player)
+        user = User(self.test_dict)
+        users.save(user)
+        player = Player(name='jack', score=3, team=user)
+        self.assertEqual((player.name, player.slug), (u'jack', u'jack'))
+        self.assertTrue(isinstance(player.score, float))
+        players.save(player)
+        player = players.find_one(name=u'jack')
+        self.assertEqual(player.team.id, user._id)
+        player.score = 'high'
+        self.assertRaises(ValidationError, players.save, player)
+        self.collection.Player.insert({'name': u'old', 'score': 'x'})
+        self.assertEqual(players.find_one(name=u'old').score, 'x')
+        self.assertEqual(players.find_one(name=u'old').slug, u'old')
+        self.assertEqual(Player().score, 0.0)
+
+    def testSession(self):
+        users = Manager(self.collection, User)
+        accounts = Manager(self.collection, Account)
+        user = User(self.test_dict)
+        with users.session(accounts):
+            users.save(user)
+            user.age = 30
+            users.save(user)
+            accounts.save(Account(email=u'john@example.com'))
+            self.assertEqual(users.find().count(), 0)
+        self.assertEqual(users.find_one(_id=user._id).age, 30)
+        self.assertEqual(accounts.find().count(), 1)
+        with users.session():
+            for i in range(3):
+                users.find(_id=user._id).update(inc__age=1)
+            users.find(_id=user._id).update(set__name=u'jack')
+        user = users.find_one(_id=user._id)
+        self.assertEqual((user.age, user.name), (33, u'jack'))
+        users.save(User(name=u'jim', age=33))
+        with users.session():
+            for i in range(2):
+                users.find(age=33).update(inc__age=1)
+        self.assertEqual(sorted(u.age for u in users.find()), [34, 34])
+        users.find(name=u'jim').remove()
+        kim = User(name=u'kim')
+        with users.session():
+            for document in (user, kim):
+                users.save(document)
+                users.find(_id=document._id).update(inc__age=1)
+                document.age = 50
+                users.save(document)
+        self.assertEqual([u.age for u in users.find(age=50)], [50, 50])
+        users.find(name=u'kim').remove()
+        try:
+            with users.session():
+                users.delete(user)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(users.find().count(), 1)
+
+    def testWriteBehind(self):
+        failed = []
+        queue = WriteBehind(batch_size=10, interval=1,
+                            on_error=lambda *args: failed.append(args))
+        users = Manager(self.collection, User, write_behind=queue)
+        models = [User(name=u'user%d' % i, age=i) for i in range(25)]
+        for model in models:
+            users.save(model)
+        for i in range(5):
+            users.find(_id=models[0]._id).update(inc__age=1)
+        queue.flush()
+        self.assertEqual(Manager(self.collection, User).find().count(), 25)
+        self.assertEqual(users.find_one(_id=models[0]._id).age, 5)
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['written']), (0, 26))
+        for i in range(2):
+            users.find(age=24).update(inc__age=1)
+        queue.flush()
+        self.assertEqual(users.find_one(_id=models[24]._id).age, 25)
+        user = User(self.test_dict)
+        friends = user.friends
+        users.save(user)
+        friends.append(u'jim')
+        queue.flush()
+        self.assertEqual(users.find_one(_id=user._id).friends,
+                         self.test_dict['friends'])
+        logins = Manager(self.collection, Login, write_behind=queue)
+        logins.save(Login(name=u'bad'))
+        queue.flush()
+        logins.save(Login(name=u'good'))
+        queue.flush()
+        self.assertEqual(logins.find().count(), 2)
+        queue.close()
+        self.assertEqual([args[2] for args in failed], ['post_save'])
+
+    def testLazy(self):
+        users = Manager(self.collection, User)
+        users.save(User(self.test_dict, age=20))
+        user = users.find().lazy().next()
+        self.assertEqual(user, users.find().next())
+        user = users.find().lazy().next()
+        self.assertEqual(user.copy()['friends'], self.test_dict['friends'])
+        user = users.find().lazy().next()
+        self.assertEqual(user.me.gender, u'male')
+        self.assertEqual(user.friends[1], u'dwight')
+        user.age = 21
+        users.save(user)
+        user = users.find().lazy().only('name').next()
+        self.assertEqual((user.name, user.age), (u'john', 21))
+        self.assertEqual(users.find().lazy().count(), 1)
+
+    def testRouter(self):
+        def down():
+            raise pymongo.errors.AutoReconnect('down')
+        router = Router({'primary': Pool(lambda: self.collection),
+                         'replica': Pool(down, retry_after=60),
+                         'scans': Pool(lambda: self.collection,
+                                       max_in_flight=1)},
+                        default={'read': ['replica', 'primary'],
+                                 'write': 'primary'}, wait_timeout=0.1)
+        router.add_rule(User, scan='scans')
+        users = Manager(router, User)
+        users.save(User(self.test_dict))
+        self.assertEqual(users.find_one(name=u'john').name, u'john')
+        self.assertEqual(users.find(name=u'john').count(), 1)
+        stats = router.stats()
+        self.assertFalse(stats['replica']['healthy'])
+        self.assertEqual(stats['replica']['failures'], 1)
+        scan = users.find().route('scan')
+        scan.next()
+        self.assertRaises(PoolTimeout, list, users.find().route('scan'))
+        self.assertEqual(router.stats()['scans']['timeouts'], 1)
+
+        class Dropped(object):
+            def __getitem__(self, name):
+                raise pymongo.errors.AutoReconnect('dropped')
+        router = Router({'primary': Pool(Dropped),
+                         'secondary': Pool(lambda: self.collection)},
+                        default={'read': ['primary', 'secondary'],
+                                 'write': ['primary', 'secondary']})
+        users = Manager(router, User)
+        self.assertRaises(pymongo.errors.AutoReconnect, users.save,
+                          User(name=u'jim'))
+        self.assertEqual(users.find(name=u'jim').count(), 0)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestMongoModels))